@@ -1,3 +1,4 @@
+import numpy as np
 import torchvision
 
 def load_data():
@@ -8,4 +9,67 @@ def load_data():
     test_data = test_dataset.data.numpy()
     test_label = test_dataset.targets.numpy()
     labels = train_dataset.classes
-    return train_data, train_label, test_data, test_label, labels
\ No newline at end of file
+    return train_data, train_label, test_data, test_label, labels
+
+def pairwise_distances(A, B, metric='l2', memory_budget=256 * 2**20, out=None):
+    """
+    L1 or L2 distances between every row of A and every row of B, computed
+    block by block with vectorized numpy operations. A and B are converted to
+    float64 one block at a time, and blocks are sized so that all temporaries
+    (the float64 blocks of A and B and the per-block results) take at most
+    about memory_budget bytes. Only `out` grows with the size of A and B (a
+    10000 x 60000 float32 `out` is 2.4 GB; pass an np.memmap to keep it on
+    disk).
+
+    L2 uses ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b, i.e. one matrix product
+    per block. The arithmetic is done in float64 so that uint8 images neither
+    wrap around nor lose precision in the subtraction.
+
+    Inputs:
+    - A: Array of shape (M, D), e.g. flattened test images
+    - B: Array of shape (N, D), e.g. flattened training images
+    - metric: 'l1' or 'l2'
+    - memory_budget: Approximate number of bytes of temporaries per block
+    - out: Optional array of shape (M, N) to write the distances to
+
+    Returns:
+    - out: Array of shape (M, N); out[i, j] is the distance between A[i] and
+      B[j]. float32 unless out is given.
+    """
+    if metric not in ('l1', 'l2'):
+        raise ValueError("metric can only be 'l1' or 'l2'")
+    M, D = A.shape
+    N = B.shape[0]
+    if out is None:
+        out = np.empty((M, N), dtype=np.float32)
+    itemsize = np.dtype(np.float64).itemsize
+    half_budget = memory_budget // 2
+
+    if metric == 'l2':
+        # half the budget for a block of B, half for a block of A and the
+        # (rows, cols) block of products
+        cols = min(N, max(1, half_budget // (D * itemsize)))
+        rows = max(1, half_budget // ((D + cols) * itemsize))
+    else:
+        # L1 has no matrix product form; the (rows, cols, D) differences
+        # dominate, so use square-ish blocks
+        cols = min(N, max(1, int((half_budget // (D * itemsize)) ** 0.5)))
+        rows = max(1, half_budget // (cols * D * itemsize))
+
+    for j in range(0, N, cols):
+        B_blk = np.asarray(B[j:j + cols], dtype=np.float64)
+        if metric == 'l2':
+            B_sq = np.einsum('ij,ij->i', B_blk, B_blk)
+        for i in range(0, M, rows):
+            A_blk = np.asarray(A[i:i + rows], dtype=np.float64)
+            if metric == 'l2':
+                d2 = A_blk @ B_blk.T
+                d2 *= -2
+                d2 += np.einsum('ij,ij->i', A_blk, A_blk)[:, None]
+                d2 += B_sq[None, :]
+                np.maximum(d2, 0, out=d2)  # rounding can make d2 slightly negative
+                out[i:i + rows, j:j + cols] = np.sqrt(d2, out=d2)
+            else:
+                diff = A_blk[:, None, :] - B_blk[None, :, :]
+                out[i:i + rows, j:j + cols] = np.abs(diff, out=diff).sum(axis=2)
+    return out
\ No newline at end of file
@@ -2,7 +2,9 @@
 Implements convolutional networks in PyTorch.
 WARNING: you SHOULD NOT use ".to()" or ".cuda()" in each implementation block.
 """
+import copy
 import torch
+import torch.nn.grad
 import random
 import numpy as np
 from utils import Solver
@@ -16,6 +18,55 @@ def hello_convolutional_networks():
   """
   print('Hello from convolutional_networks.py!')
 
+
+def _im2col(x, HH, WW, pad, stride):
+  """
+  Unfold every (HH, WW) receptive field of the zero-padded input into a column.
+
+  Inputs:
+  - x: Input data of shape (N, C, H, W)
+  - HH, WW: Height and width of the receptive field
+  - pad, stride: Same meaning as in conv_param
+
+  Returns:
+  - x_cols: Tensor of shape (N, C * HH * WW, H' * W')
+  """
+  return torch.nn.functional.unfold(x, (HH, WW), padding=pad, stride=stride)
+
+
+def _window_view(x, HH, WW, stride):
+  """
+  Zero-copy sliding-window view of x built on Tensor.unfold (as_strided
+  under the hood); entry [n, c, i, j] is the (HH, WW) window whose top-left
+  corner is at (i * stride, j * stride). Pad x beforehand if needed.
+
+  Inputs:
+  - x: Input data of shape (N, C, H, W)
+  - HH, WW: Height and width of each window
+  - stride: Distance between adjacent windows
+
+  Returns:
+  - windows: View of x of shape (N, C, H', W', HH, WW)
+  """
+  return x.unfold(2, HH, stride).unfold(3, WW, stride)
+
+
+def _col2im(x_cols, x_shape, HH, WW, pad, stride):
+  """
+  Inverse of _im2col: scatter-add every column back onto its receptive field
+  and drop the padding.
+
+  Inputs:
+  - x_cols: Tensor of shape (N, C * HH * WW, H' * W')
+  - x_shape: Shape (N, C, H, W) of the unpadded input
+  - HH, WW, pad, stride: Same as in _im2col
+
+  Returns:
+  - x: Tensor of shape (N, C, H, W)
+  """
+  H, W = x_shape[2:]
+  return torch.nn.functional.fold(x_cols, (H, W), (HH, WW), padding=pad, stride=stride)
+
 # done
 class Conv(object):
 
@@ -35,6 +86,9 @@ class Conv(object):
       - 'stride': The number of pixels between adjacent receptive fields in the
       horizontal and vertical directions.
       - 'pad': The number of pixels that will be used to zero-pad the input. 
+      - 'method': Optional; 'naive' (default) loops over every output pixel,
+      'im2col' unfolds the receptive fields into columns and convolves all
+      of them with a single matrix multiply.
       
     During padding, 'pad' zeros should be placed symmetrically (i.e equally on both sides)
     along the height and width axes of the input. Be careful not to modfiy the original
@@ -44,7 +98,8 @@ class Conv(object):
     - out: Output data, of shape (N, F, H', W') where H' and W' are given by
       H' = 1 + (H + 2 * pad - HH) / stride
       W' = 1 + (W + 2 * pad - WW) / stride
-    - cache: (x, w, b, conv_param)
+    - cache: (x, w, b, conv_param), plus the unfolded columns of x when the
+      'im2col' method is used
     """
     out = None
     ##############################################################################
@@ -59,30 +114,43 @@ class Conv(object):
     F, C, HH, WW = w.shape
     stride = conv_param["stride"]
     padding = conv_param["pad"]
+    method = conv_param.get("method", "naive")
 
     # Compute output tensor size
     output_height = int((H + 2 * padding - HH) / stride + 1)
     output_width = int((W + 2 * padding - WW) / stride + 1)
-    
-    # padding
-    input_tensor_padded = torch.nn.functional.pad(x, (padding, padding, padding, padding))
-
-    # Initialize output tensor and add bias
-    out = torch.zeros((N, F, output_height, output_width), device = input_tensor_padded.device, dtype=torch.float64)
-
-    # Convolution operation
-    for i in range(N):
-        for c_out in range(F):
-            for h_out in range(output_height):
-                for w_out in range(output_width):
-                    h_in = h_out * stride
-                    w_in = w_out * stride
-                    out[i, c_out, h_out, w_out] = torch.sum(w[c_out] * input_tensor_padded[i, :, h_in:h_in+HH, w_in:w_in+WW]) + b[c_out]
+
+    if method == "im2col":
+      # (N, C*HH*WW, H'*W') columns, one matmul against the (F, C*HH*WW) filters
+      x_cols = _im2col(x, HH, WW, padding, stride)
+      out = w.reshape(F, -1).matmul(x_cols) + b.reshape(1, F, 1)
+      out = out.reshape(N, F, output_height, output_width)
+
+    elif method == "naive":
+      # padding
+      input_tensor_padded = torch.nn.functional.pad(x, (padding, padding, padding, padding))
+
+      # (N, C, H', W', HH, WW) view of every receptive field, no copy
+      windows = _window_view(input_tensor_padded, HH, WW, stride)
+
+      # Initialize output tensor and add bias
+      out = b.reshape(1, F, 1, 1).repeat(N, 1, output_height, output_width)
+
+      # Convolution operation: one channel contraction per filter offset, so
+      # at most one input-sized slice is materialized at a time
+      for i in range(HH):
+          for j in range(WW):
+              out += torch.einsum('nchw,fc->nfhw', windows[..., i, j], w[:, :, i, j])
+
+    else:
+      raise ValueError('Invalid conv method "%s"' % method)
                     
     #############################################################################
     #                              END OF YOUR CODE                             #
     #############################################################################
     cache = (x, w, b, conv_param)
+    if method == "im2col":
+      cache += (x_cols,)
     return out, cache
 
   @staticmethod
@@ -92,7 +160,8 @@ class Conv(object):
 
     Inputs:
     - dout: Upstream derivatives.
-    - cache: A tuple of (x, w, b, conv_param) as in conv_forward_naive
+    - cache: A tuple of (x, w, b, conv_param) as in conv_forward_naive; the
+      columns saved by the 'im2col' forward are reused when present
 
     Returns a tuple of:
     - dx: Gradient with respect to x
@@ -106,35 +175,29 @@ class Conv(object):
     # Replace "pass" statement with your code
     
     # 取得cache的內容
-    x, w, b, conv_param = cache
-    
+    x, w, b, conv_param = cache[:4]
+
     # 設定 padding 和 stride
     padding = conv_param["pad"]
     stride = conv_param["stride"]
 
-    # 設定 x_pad
-    x_pad = torch.nn.functional.pad(x, (padding, padding, padding, padding))
-    
     #設定維度
-    N, C, H, W = x_pad.shape
+    N, C, H, W = x.shape
     F, _, HH, WW = w.shape
 
-    # 初始化梯度
-    dx_pad = torch.zeros_like(x_pad)
-    dw = torch.zeros_like(w)
+    # 重用 forward 存下的 columns, 沒有的話 (naive forward) 再展開一次
+    x_cols = cache[4] if len(cache) > 4 else _im2col(x, HH, WW, padding, stride)
+    dout_cols = dout.reshape(N, F, -1).to(x.dtype)
 
     # 計算db
     db = torch.sum(dout, axis=(0, 2, 3))
 
-    for n in range(N):
-        for f in range(F):
-          for i in range(0, H - HH + 1, stride):
-            for j in range(0, W - WW + 1, stride):
-             # dout[n, f, i, j]
-              dx_pad[n, :, i : i + HH, j : j + WW] += dout[n, f, i//stride, j//stride] * w[f]
-              dw[f] += dout[n, f, i//stride, j//stride] * x_pad[n, :, i : i + HH, j : j + WW]
-    
-    dx = dx_pad[:, :, padding:-padding, padding:-padding]
+    # dw: 對 batch 和所有輸出位置一次相乘相加, (F, N*H'*W') x (N*H'*W', C*HH*WW)
+    dw = torch.tensordot(dout_cols, x_cols, dims=([0, 2], [0, 2])).reshape(w.shape)
+
+    # dx: 轉置相乘得到每個 column 的梯度, 再用 col2im 疊回輸入 (同時去掉 padding)
+    dx_cols = w.reshape(F, -1).t().matmul(dout_cols)
+    dx = _col2im(dx_cols, x.shape, HH, WW, padding, stride)
 
     #############################################################################
     #                              END OF YOUR CODE                             #
@@ -161,7 +224,8 @@ class MaxPool(object):
     - out: Output data, of shape (N, C, H', W') where H' and W' are given by
       H' = 1 + (H - pool_height) / stride
       W' = 1 + (W - pool_width) / stride
-    - cache: (x, pool_param)
+    - cache: (x_shape, pool_param, argmax), where argmax holds, for every
+      output element, the flat index of its winner inside the (H, W) plane
     """
     out = None
     #############################################################################
@@ -174,26 +238,33 @@ class MaxPool(object):
     pool_width = pool_param["pool_width"]
     stride = pool_param["stride"]
 
-    # set the dimension
     N, C, H, W = x.shape
-    out_height = int((H - pool_height) / stride) + 1
-    out_width = int((W - pool_width) / stride) + 1
-
-    # Initialize the output tensor
-    out = torch.zeros(N, C, out_height, out_width, dtype=torch.float64).to(x.device)
-
-    # Apply max pooling
-    for n in range(N):
-        for c in range(C):
-          for i in range(out_height):
-            for j in range(out_width):
-              pool_field = x[n, c, i*pool_height:i*pool_height+pool_height, j*pool_width:j*pool_width+pool_width]
-              out[n, c, i, j] = torch.max(pool_field)
+    if (pool_height == stride and pool_width == stride
+        and H % pool_height == 0 and W % pool_width == 0):
+      # Non-overlapping tiling: the windows are just a reshape of x to
+      # (N, C, H', pool_height, W', pool_width); reduce its two pool axes
+      tiles = x.reshape(N, C, H // pool_height, pool_height, W // pool_width, pool_width)
+      row_max, col_idx = tiles.max(dim=5)
+      out, row_idx = row_max.max(dim=3)
+      col_idx = col_idx.gather(3, row_idx.unsqueeze(3)).squeeze(3)
+    else:
+      # Apply max pooling: reduce the (N, C, H', W', pool_height, pool_width)
+      # window view over its columns and then its rows, keeping both argmaxes
+      windows = _window_view(x, pool_height, pool_width, stride)
+      row_max, col_idx = windows.max(dim=-1)
+      out, row_idx = row_max.max(dim=-1)
+      col_idx = col_idx.gather(-1, row_idx.unsqueeze(-1)).squeeze(-1)
+
+    # flat index of every winner inside its (H, W) input plane
+    _, _, out_height, out_width = out.shape
+    rows = torch.arange(out_height, device=x.device).reshape(-1, 1) * stride + row_idx
+    cols = torch.arange(out_width, device=x.device) * stride + col_idx
+    argmax = rows * W + cols
 
     #############################################################################
     #                              END OF YOUR CODE                             #
     #############################################################################
-    cache = (x, pool_param)
+    cache = (x.shape, pool_param, argmax)
     return out, cache
 
   @staticmethod
@@ -202,7 +273,7 @@ class MaxPool(object):
     A naive implementation of the backward pass for a max-pooling layer.
     Inputs:
     - dout: Upstream derivatives
-    - cache: A tuple of (x, pool_param) as in the forward pass.
+    - cache: A tuple of (x_shape, pool_param, argmax) as in the forward pass.
     Returns:
     - dx: Gradient with respect to x
     """
@@ -213,32 +284,13 @@ class MaxPool(object):
     # Replace "pass" statement with your code
     
     # set the variables
-    x, pool_param = cache
-    N, C, H, W = x.shape
-    pool_height = pool_param["pool_height"]
-    pool_width = pool_param["pool_width"]
-    stride = pool_param["stride"]
-    _, _, out_height, out_width = dout.shape
-
-    # initialization
-    dx = torch.zeros_like(x)
-
-    # Compute gradient for each element in the output
-    for n in range(N):
-        for c in range(C):
-            for i in range(out_height):
-                h_start = i * stride
-                h_end = h_start + pool_height
-                for j in range(out_width):
-                    w_start = j * stride
-                    w_end = w_start + pool_width
-
-                    # find the slice of the input volume
-                    x_slice = x[n, c, h_start:h_end, w_start:w_end]
-                    # find the maximum value in the slice
-                    mask = (x_slice == torch.max(x_slice))
-                    # assign the gradients to the maximum value in the slice
-                    dx[n, c, h_start:h_end, w_start:w_end] += mask * dout[n, c, i, j]
+    x_shape, pool_param, argmax = cache
+    N, C, H, W = x_shape
+
+    # route every upstream gradient to the single winner of its window
+    dx = torch.zeros(N, C, H * W, dtype=dout.dtype, device=dout.device)
+    dx.scatter_add_(2, argmax.reshape(N, C, -1), dout.reshape(N, C, -1))
+    dx = dx.reshape(x_shape)
 
     #############################################################################
     #                              END OF YOUR CODE                             #
@@ -257,7 +309,7 @@ class ThreeLayerConvNet(object):
 
   def __init__(self, input_dims=(3, 32, 32), num_filters=32, filter_size=7,
          hidden_dim=100, num_classes=10, weight_scale=1e-3, reg=0.0,
-         dtype=torch.float, device='cpu'):
+         dtype=torch.float, device='cpu', conv_method='fast'):
     """
     Initialize a new network.
     Inputs:
@@ -273,10 +325,13 @@ class ThreeLayerConvNet(object):
       this datatype. float is faster but less accurate, so you should use
       double for numeric gradient checking.
     - device: device to use for computation. 'cpu' or 'cuda'
+    - conv_method: Convolution implementation; 'fast' uses FastConv, while
+      'naive' or 'im2col' use the from-scratch Conv layer.
     """
     self.params = {}
     self.reg = reg
     self.dtype = dtype
+    self.conv_method = conv_method
 
     ############################################################################
     # TODO: Initialize weights and biases for the three-layer convolutional    #
@@ -312,6 +367,7 @@ class ThreeLayerConvNet(object):
       'reg': self.reg,
       'dtype': self.dtype,
       'params': self.params,
+      'conv_method': self.conv_method,
     }
       
     torch.save(checkpoint, path)
@@ -322,6 +378,7 @@ class ThreeLayerConvNet(object):
     self.params = checkpoint['params']
     self.dtype = checkpoint['dtype']
     self.reg = checkpoint['reg']
+    self.conv_method = checkpoint.get('conv_method', 'fast')
     print("load checkpoint file: {}".format(path))
 
 
@@ -338,7 +395,7 @@ class ThreeLayerConvNet(object):
     # pass conv_param to the forward pass for the convolutional layer
     # Padding and stride chosen to preserve the input spatial size
     filter_size = W1.shape[2]
-    conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2}
+    conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2, 'method': self.conv_method}
 
     # pass pool_param to the forward pass for the max-pooling layer
     pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
@@ -429,7 +486,7 @@ class DeepConvNet(object):
                batchnorm=False,
                num_classes=10, weight_scale=1e-3, reg=0.0,
                weight_initializer=None,
-               dtype=torch.float, device='cpu'):
+               dtype=torch.float, device='cpu', conv_method='fast'):
     """
     Initialize a new network.
 
@@ -450,6 +507,8 @@ class DeepConvNet(object):
       this datatype. float is faster but less accurate, so you should use
       double for numeric gradient checking.
     - device: device to use for computation. 'cpu' or 'cuda'    
+    - conv_method: Convolution implementation; 'fast' uses FastConv, while
+      'naive' or 'im2col' use the from-scratch Conv layer.
     """
     self.params = {}
     self.num_layers = len(num_filters)+1
@@ -457,6 +516,7 @@ class DeepConvNet(object):
     self.batchnorm = batchnorm
     self.reg = reg
     self.dtype = dtype
+    self.conv_method = conv_method
   
     if device == 'cuda':
       device = 'cuda:0'
@@ -555,6 +615,7 @@ class DeepConvNet(object):
       'max_pools': self.max_pools,
       'batchnorm': self.batchnorm,
       'bn_params': self.bn_params,
+      'conv_method': self.conv_method,
     }
       
     torch.save(checkpoint, path)
@@ -570,6 +631,7 @@ class DeepConvNet(object):
     self.max_pools = checkpoint['max_pools']
     self.batchnorm = checkpoint['batchnorm']
     self.bn_params = checkpoint['bn_params']
+    self.conv_method = checkpoint.get('conv_method', 'fast')
 
 
     for p in self.params:
@@ -582,6 +644,36 @@ class DeepConvNet(object):
     print("load checkpoint file: {}".format(path))
 
 
+  def fold_batchnorm(self):
+    """
+    Build an inference copy of this network with every batchnorm layer folded
+    into the convolution before it, using the running statistics:
+
+      scale = gamma / sqrt(running_var + eps)
+      W' = W * scale,  b' = (b - running_mean) * scale + beta
+
+    The returned network has batchnorm=False and gives the same test-time
+    scores as this one without the per-layer normalization pass. This network
+    is left untouched.
+    """
+    model = copy.copy(self)
+    model.params = {k: v.clone() for k, v in self.params.items()}
+    if not self.batchnorm:
+      return model
+
+    model.batchnorm = False
+    model.bn_params = []
+    for i in range(1, self.num_layers):
+      bn_param = self.bn_params[i-1]
+      gamma, beta = model.params.pop(f'gamma{i}'), model.params.pop(f'beta{i}')
+      running_mean = bn_param.get('running_mean', torch.zeros_like(gamma))
+      running_var = bn_param.get('running_var', torch.zeros_like(gamma))
+      scale = gamma * torch.rsqrt(running_var + bn_param.get('eps', 1e-5))
+      model.params[f'W{i}'] = model.params[f'W{i}'] * scale.reshape(-1, 1, 1, 1)
+      model.params[f'b{i}'] = (model.params[f'b{i}'] - running_mean) * scale + beta
+    return model
+
+
   def loss(self, X, y=None):
     """
     Evaluate loss and gradient for the deep convolutional network.
@@ -600,7 +692,7 @@ class DeepConvNet(object):
     # pass conv_param to the forward pass for the convolutional layer
     # Padding and stride chosen to preserve the input spatial size
     filter_size = 3
-    conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2}
+    conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2, 'method': self.conv_method}
 
     # pass pool_param to the forward pass for the max-pooling layer
     pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
@@ -852,7 +944,7 @@ class BatchNorm(object):
 
     Returns a tuple of:
     - out: of shape (N, D)
-    - cache: A tuple of values needed in the backward pass
+    - cache: A tuple (x_hat, inv_std, gamma) of values needed in the backward pass
     """
     mode = bn_param['mode']
     eps = bn_param.get('eps', 1e-5)
@@ -887,15 +979,17 @@ class BatchNorm(object):
       #######################################################################
       # Replace "pass" statement with your code
       
-      sample_mean = torch.mean(x, axis=0)
-      sample_var = torch.var(x, axis=0)
+      # mean and variance from a single fused pass over x
+      sample_var, sample_mean = torch.var_mean(x, dim=0)
       running_mean = momentum * running_mean + (1 - momentum) * sample_mean
       running_var = momentum * running_var + (1 - momentum) * sample_var
       
-      x_hat = (x - sample_mean) / (torch.sqrt(sample_var + eps))
+      inv_std = torch.rsqrt(sample_var + eps)
+      x_hat = (x - sample_mean) * inv_std
       out = gamma * x_hat + beta
 
-      cache = x, x_hat, sample_mean, sample_var, eps, gamma
+      # x - sample_mean and (sample_var + eps) ** -0.5 are recoverable from these
+      cache = x_hat, inv_std, gamma
 
       #######################################################################
       #                           END OF YOUR CODE                          #
@@ -952,13 +1046,15 @@ class BatchNorm(object):
     # Replace "pass" statement with your code
 
     N, D = dout.shape
-    x, x_hat, sample_mean, sample_var, eps, gamma = cache
+    x_hat, inv_std, gamma = cache
     dbeta = torch.sum(dout, axis=0)
     dgamma = torch.sum(x_hat * dout, axis=0)
 
-    dvar = torch.sum(gamma * dout * (x - sample_mean) * (-0.5) * torch.pow(sample_var + eps, -1.5), axis=0)
-    dmean = torch.sum(gamma * dout * (-1.0) * torch.pow(sample_var + eps, -0.5), axis=0) + dvar * (-2.0 / N) * torch.sum(x - sample_mean, axis=0)
-    dx = dout * gamma * torch.pow(sample_var + eps, -0.5) + dvar * 2.0 * (x - sample_mean) / N + dmean / N
+    # x - mean = x_hat / inv_std, and (var + eps) ** -1.5 = inv_std ** 3
+    x_mu = x_hat / inv_std
+    dvar = torch.sum(gamma * dout * x_mu, axis=0) * (-0.5) * inv_std ** 3
+    dmean = torch.sum(gamma * dout, axis=0) * (-inv_std) + dvar * (-2.0 / N) * torch.sum(x_mu, axis=0)
+    dx = dout * gamma * inv_std + dvar * 2.0 * x_mu / N + dmean / N
 
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -992,11 +1088,11 @@ class BatchNorm(object):
     # Replace "pass" statement with your code
     
     N, D = dout.shape
-    x, x_hat, sample_mean, sample_var, eps, gamma = cache
+    x_hat, inv_std, gamma = cache
     dbeta = torch.sum(dout, axis=0)
     dgamma = torch.sum(x_hat * dout, axis=0)
     dxhat = dout * gamma
-    dx = (1. / (N * torch.sqrt(sample_var + eps))) * (N*dxhat - torch.sum(dxhat, axis=0) - x_hat*torch.sum(dxhat*x_hat, axis=0))
+    dx = (inv_std / N) * (N*dxhat - torch.sum(dxhat, axis=0) - x_hat*torch.sum(dxhat*x_hat, axis=0))
 
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -1025,6 +1121,8 @@ class SpatialBatchNorm(object):
       default of momentum=0.9 should work well in most situations.
       - running_mean: Array of shape (C,) giving running mean of features
       - running_var Array of shape (C,) giving running variance of features
+      - memory_format: Optional; 'channels_last' keeps x, out and the cached
+      tensors in torch.channels_last layout (cheap when x already is).
 
     Returns a tuple of:
     - out: Output data, of shape (N, C, H, W)
@@ -1041,12 +1139,37 @@ class SpatialBatchNorm(object):
     ###########################################################################
     # Replace "pass" statement with your code
     
+    # Normalize in the native layout: reduce over (N, H, W) with keepdim so the
+    # per-channel statistics broadcast against x without permute copies.
+    mode = bn_param['mode']
+    eps = bn_param.get('eps', 1e-5)
+    momentum = bn_param.get('momentum', 0.9)
+    memory_format = bn_param.get('memory_format', None)
+    if memory_format == 'channels_last':
+      x = x.contiguous(memory_format=torch.channels_last)
+
     N, C, H, W = x.shape
-    x = x.permute(0, 2, 3, 1).reshape(N * H * W, C)
-    # x = x.reshape(N * H * W, C)
-    out, cache = BatchNorm.forward(x, gamma, beta, bn_param)
-    out = out.reshape(N, H, W, C).permute(0, 3, 1, 2)
-    # out = out.reshape(N, C, H, W)
+    running_mean = bn_param.get('running_mean', torch.zeros(C, dtype=x.dtype, device=x.device))
+    running_var = bn_param.get('running_var', torch.zeros(C, dtype=x.dtype, device=x.device))
+
+    if mode == 'train':
+      sample_var, sample_mean = torch.var_mean(x, dim=(0, 2, 3), keepdim=True)
+      running_mean = momentum * running_mean + (1 - momentum) * sample_mean.reshape(C)
+      running_var = momentum * running_var + (1 - momentum) * sample_var.reshape(C)
+    elif mode == 'test':
+      sample_mean = running_mean.reshape(1, C, 1, 1)
+      sample_var = running_var.reshape(1, C, 1, 1)
+    else:
+      raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+    inv_std = torch.rsqrt(sample_var + eps)
+    x_hat = (x - sample_mean) * inv_std
+    out = gamma.reshape(1, C, 1, 1) * x_hat + beta.reshape(1, C, 1, 1)
+    cache = (x_hat, inv_std, gamma, memory_format)
+
+    # Store the updated running means back into bn_param
+    bn_param['running_mean'] = running_mean.detach()
+    bn_param['running_var'] = running_var.detach()
 
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -1077,12 +1200,17 @@ class SpatialBatchNorm(object):
     ###########################################################################
     # Replace "pass" statement with your code
     
+    # Same simplified expression as BatchNorm.backward_alt, with the sums
+    # taken over (N, H, W) of the native (N, C, H, W) layout.
+    x_hat, inv_std, gamma, memory_format = cache
+    if memory_format == 'channels_last':
+      dout = dout.contiguous(memory_format=torch.channels_last)
+
     N, C, H, W = dout.shape
-    dout = dout.permute(0, 2, 3, 1).reshape(N * H * W, C)
-    # dout = dout.reshape(N * H * W, C)
-    dx, dgamma, dbeta = BatchNorm.backward_alt(dout, cache)
-    dx = dx.reshape(N, H, W, C).permute(0, 3, 1, 2)
-    # dx = dx.reshape(N, C, H, W)
+    M = N * H * W
+    dbeta = torch.sum(dout, dim=(0, 2, 3))
+    dgamma = torch.sum(dout * x_hat, dim=(0, 2, 3))
+    dx = (gamma.reshape(1, C, 1, 1) * inv_std / M) * (M * dout - dbeta.reshape(1, C, 1, 1) - x_hat * dgamma.reshape(1, C, 1, 1))
 
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -1102,29 +1230,23 @@ class FastConv(object):
 
   @staticmethod
   def forward(x, w, b, conv_param):
-    N, C, H, W = x.shape
-    F, _, HH, WW = w.shape
     stride, pad = conv_param['stride'], conv_param['pad']
-    layer = torch.nn.Conv2d(C, F, (HH, WW), stride=stride, padding=pad)
-    layer.weight = torch.nn.Parameter(w)
-    layer.bias = torch.nn.Parameter(b)
-    tx = x.detach()
-    tx.requires_grad = True
-    out = layer(tx)
-    cache = (x, w, b, conv_param, tx, out, layer)
+    tx, tw, tb = x.detach(), w.detach(), b.detach()
+    if torch.is_grad_enabled():
+      tx.requires_grad_()
+      tw.requires_grad_()
+      tb.requires_grad_()
+    out = torch.nn.functional.conv2d(tx, tw, tb, stride=stride, padding=pad)
+    cache = (x, w, b, conv_param, tx, tw, tb, out)
     return out, cache
 
   @staticmethod
   def backward(dout, cache):
     try:
-      x, _, _, _, tx, out, layer = cache
-      out.backward(dout)
-      dx = tx.grad.detach()
-      dw = layer.weight.grad.detach()
-      db = layer.bias.grad.detach()
-      layer.weight.grad = layer.bias.grad = None
+      x, _, _, _, tx, tw, tb, out = cache
+      dx, dw, db = torch.autograd.grad(out, (tx, tw, tb), dout)
     except RuntimeError:
-      dx, dw, db = torch.zeros_like(tx), torch.zeros_like(layer.weight), torch.zeros_like(layer.bias)
+      dx, dw, db = torch.zeros_like(tx), torch.zeros_like(tw), torch.zeros_like(tb)
     return dx, dw, db
 
 
@@ -1132,27 +1254,36 @@ class FastMaxPool(object):
 
   @staticmethod
   def forward(x, pool_param):
-    N, C, H, W = x.shape
     pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
     stride = pool_param['stride']
-    layer = torch.nn.MaxPool2d(kernel_size=(pool_height, pool_width), stride=stride)
     tx = x.detach()
-    tx.requires_grad = True
-    out = layer(tx)
-    cache = (x, pool_param, tx, out, layer)
+    if torch.is_grad_enabled():
+      tx.requires_grad_()
+    out = torch.nn.functional.max_pool2d(tx, (pool_height, pool_width), stride=stride)
+    cache = (x, pool_param, tx, out)
     return out, cache
 
   @staticmethod
   def backward(dout, cache):
     try:
-      x, _, tx, out, layer = cache
-      out.backward(dout)
-      dx = tx.grad.detach()
+      x, _, tx, out = cache
+      dx, = torch.autograd.grad(out, tx, dout)
     except RuntimeError:
       dx = torch.zeros_like(tx)
     return dx
 
 
+def _conv_layer(conv_param):
+  """
+  Pick the convolution implementation used by the sandwich layers. Unless
+  conv_param asks for one of the from-scratch methods of Conv ('naive' or
+  'im2col'), the sandwich layers go through FastConv.
+  """
+  if conv_param.get('method', 'fast') == 'fast':
+    return FastConv
+  return Conv
+
+
 class Conv_ReLU(object):
 
   @staticmethod
@@ -1166,7 +1297,7 @@ class Conv_ReLU(object):
     - out: Output from the ReLU
     - cache: Object to give to the backward pass
     """
-    a, conv_cache = FastConv.forward(x, w, b, conv_param)
+    a, conv_cache = _conv_layer(conv_param).forward(x, w, b, conv_param)
     out, relu_cache = ReLU.forward(a)
     cache = (conv_cache, relu_cache)
     return out, cache
@@ -1178,7 +1309,7 @@ class Conv_ReLU(object):
     """
     conv_cache, relu_cache = cache
     da = ReLU.backward(dout, relu_cache)
-    dx, dw, db = FastConv.backward(da, conv_cache)
+    dx, dw, db = _conv_layer(conv_cache[3]).backward(da, conv_cache)
     return dx, dw, db
 
 
@@ -1196,7 +1327,7 @@ class Conv_ReLU_Pool(object):
     - out: Output from the pooling layer
     - cache: Object to give to the backward pass
     """
-    a, conv_cache = FastConv.forward(x, w, b, conv_param)
+    a, conv_cache = _conv_layer(conv_param).forward(x, w, b, conv_param)
     s, relu_cache = ReLU.forward(a)
     out, pool_cache = FastMaxPool.forward(s, pool_param)
     cache = (conv_cache, relu_cache, pool_cache)
@@ -1210,7 +1341,7 @@ class Conv_ReLU_Pool(object):
     conv_cache, relu_cache, pool_cache = cache
     ds = FastMaxPool.backward(dout, pool_cache)
     da = ReLU.backward(ds, relu_cache)
-    dx, dw, db = FastConv.backward(da, conv_cache)
+    dx, dw, db = _conv_layer(conv_cache[3]).backward(da, conv_cache)
     return dx, dw, db
 
 
@@ -1245,27 +1376,106 @@ class Linear_BatchNorm_ReLU(object):
     """
     fc_cache, bn_cache, relu_cache = cache
     da_bn = ReLU.backward(dout, relu_cache)
-    da, dgamma, dbeta = BatchNorm.backward(da_bn, bn_cache)
+    da, dgamma, dbeta = BatchNorm.backward_alt(da_bn, bn_cache)
     dx, dw, db = Linear.backward(da, fc_cache)
     return dx, dw, db, dgamma, dbeta
 
 
+def _lean_conv_forward(x, w, b, conv_param):
+  """
+  Convolution forward for the fused layers whose cache does not keep the
+  output alive. The 'fast' method runs conv2d on detached tensors without
+  recording a graph, leaving the cache as (x, w, b, conv_param).
+  """
+  if conv_param.get('method', 'fast') != 'fast':
+    return Conv.forward(x, w, b, conv_param)
+  stride, pad = conv_param['stride'], conv_param['pad']
+  out = torch.nn.functional.conv2d(x.detach(), w.detach(), b.detach(), stride=stride, padding=pad)
+  cache = (x, w, b, conv_param)
+  return out, cache
+
+
+def _lean_conv_backward(dout, cache):
+  """
+  Backward pass matching _lean_conv_forward.
+  """
+  x, w, b, conv_param = cache[:4]
+  if conv_param.get('method', 'fast') != 'fast':
+    return Conv.backward(dout, cache)
+  stride, pad = conv_param['stride'], conv_param['pad']
+  dx = torch.nn.grad.conv2d_input(x.shape, w, dout, stride=stride, padding=pad)
+  dw = torch.nn.grad.conv2d_weight(x, w.shape, dout, stride=stride, padding=pad)
+  db = torch.sum(dout, dim=(0, 2, 3))
+  return dx, dw, db
+
+
 class Conv_BatchNorm_ReLU(object):
 
   @staticmethod
   def forward(x, w, b, gamma, beta, conv_param, bn_param):
-    a, conv_cache = FastConv.forward(x, w, b, conv_param)
-    an, bn_cache = SpatialBatchNorm.forward(a, gamma, beta, bn_param)
-    out, relu_cache = ReLU.forward(an)
-    cache = (conv_cache, bn_cache, relu_cache)
+    """
+    Fused convolution, spatial batch normalization and ReLU.
+    The conv output is normalized in place in (N, C, H, W) layout and the
+    ReLU is applied in place, so besides the output only x_hat is kept for
+    the backward pass; the ReLU mask is recomputed from it.
+    Inputs:
+    - x: Input to the convolutional layer
+    - w, b, conv_param: Weights and parameters for the convolutional layer
+    - gamma, beta, bn_param: Parameters for spatial batch normalization
+    Returns a tuple of:
+    - out: Output from the ReLU
+    - cache: (conv_cache, x_hat, inv_std, gamma, beta)
+    """
+    mode = bn_param['mode']
+    eps = bn_param.get('eps', 1e-5)
+    momentum = bn_param.get('momentum', 0.9)
+
+    a, conv_cache = _lean_conv_forward(x, w, b, conv_param)
+    C = a.shape[1]
+    running_mean = bn_param.get('running_mean', torch.zeros(C, dtype=a.dtype, device=a.device))
+    running_var = bn_param.get('running_var', torch.zeros(C, dtype=a.dtype, device=a.device))
+
+    if mode == 'train':
+      sample_var, sample_mean = torch.var_mean(a, dim=(0, 2, 3))
+      running_mean = momentum * running_mean + (1 - momentum) * sample_mean
+      running_var = momentum * running_var + (1 - momentum) * sample_var
+    elif mode == 'test':
+      sample_mean, sample_var = running_mean, running_var
+    else:
+      raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+    bn_param['running_mean'] = running_mean.detach()
+    bn_param['running_var'] = running_var.detach()
+
+    # a becomes x_hat; out = relu(gamma * x_hat + beta), both in place
+    inv_std = torch.rsqrt(sample_var + eps)
+    x_hat = a.sub_(sample_mean.reshape(1, C, 1, 1)).mul_(inv_std.reshape(1, C, 1, 1))
+    out = torch.addcmul(beta.reshape(1, C, 1, 1), x_hat, gamma.reshape(1, C, 1, 1))
+    out.clamp_(min=0)
+
+    cache = (conv_cache, x_hat, inv_std, gamma, beta)
     return out, cache
 
   @staticmethod
   def backward(dout, cache):
-    conv_cache, bn_cache, relu_cache = cache
-    dan = ReLU.backward(dout, relu_cache)
-    da, dgamma, dbeta = SpatialBatchNorm.backward(dan, bn_cache)
-    dx, dw, db = FastConv.backward(da, conv_cache)
+    """
+    Backward pass for the fused conv-batchnorm-relu layer.
+    """
+    conv_cache, x_hat, inv_std, gamma, beta = cache
+    C = x_hat.shape[1]
+    M = x_hat.numel() // C
+    gamma_, beta_ = gamma.reshape(1, C, 1, 1), beta.reshape(1, C, 1, 1)
+
+    # ReLU: recompute the mask from x_hat instead of caching the activation
+    dan = dout.masked_fill(torch.addcmul(beta_, x_hat, gamma_) < 0, 0)
+
+    # batchnorm, simplified form of BatchNorm.backward_alt reduced over (N, H, W)
+    dbeta = torch.sum(dan, dim=(0, 2, 3))
+    dgamma = torch.sum(dan * x_hat, dim=(0, 2, 3))
+    da = dan.mul_(M).sub_(dbeta.reshape(1, C, 1, 1))
+    da = da.addcmul_(x_hat, dgamma.reshape(1, C, 1, 1), value=-1)
+    da = da.mul_((gamma * inv_std / M).reshape(1, C, 1, 1))
+
+    dx, dw, db = _lean_conv_backward(da, conv_cache)
     return dx, dw, db, dgamma, dbeta
 
 
@@ -1273,18 +1483,21 @@ class Conv_BatchNorm_ReLU_Pool(object):
 
   @staticmethod
   def forward(x, w, b, gamma, beta, conv_param, bn_param, pool_param):
-    a, conv_cache = FastConv.forward(x, w, b, conv_param)
-    an, bn_cache = SpatialBatchNorm.forward(a, gamma, beta, bn_param)
-    s, relu_cache = ReLU.forward(an)
-    out, pool_cache = FastMaxPool.forward(s, pool_param)
-    cache = (conv_cache, bn_cache, relu_cache, pool_cache)
+    """
+    Fused conv-batchnorm-relu layer followed by a max pool. The pool keeps
+    only its argmax indices, so the full-size activation is released once
+    this returns.
+    """
+    s, cbr_cache = Conv_BatchNorm_ReLU.forward(x, w, b, gamma, beta, conv_param, bn_param)
+    out, pool_cache = MaxPool.forward(s, pool_param)
+    cache = (cbr_cache, pool_cache)
     return out, cache
 
   @staticmethod
   def backward(dout, cache):
-    conv_cache, bn_cache, relu_cache, pool_cache = cache
-    ds = FastMaxPool.backward(dout, pool_cache)
-    dan = ReLU.backward(ds, relu_cache)
-    da, dgamma, dbeta = SpatialBatchNorm.backward(dan, bn_cache)
-    dx, dw, db = FastConv.backward(da, conv_cache)
-    return dx, dw, db, dgamma, dbeta
+    """
+    Backward pass for the fused conv-batchnorm-relu-pool layer.
+    """
+    cbr_cache, pool_cache = cache
+    ds = MaxPool.backward(dout, pool_cache)
+    return Conv_BatchNorm_ReLU.backward(ds, cbr_cache)
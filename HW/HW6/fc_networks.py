@@ -1,3 +1,4 @@
+import math
 import torch
 import random
 from helper import svm_loss, softmax_loss
@@ -445,6 +446,86 @@ def adam(w, dw, config=None):
 
   return next_w, config
 
+def sgd_momentum_inplace(w, dw, config=None):
+  """
+  Allocation-free variant of sgd_momentum: w and the velocity are updated in
+  place and w itself is returned, so it is a drop-in update_rule for Solver.
+  config format: same as sgd_momentum.
+  """
+  if config is None: config = {}
+  config.setdefault('learning_rate', 1e-2)
+  config.setdefault('momentum', 0.9)
+  if 'velocity' not in config:
+    config['velocity'] = torch.zeros_like(w)
+
+  v = config['velocity']
+  v.mul_(config['momentum']).add_(dw, alpha=-config['learning_rate'])
+  w.add_(v)
+
+  return w, config
+
+def rmsprop_inplace(w, dw, config=None):
+  """
+  Allocation-free variant of rmsprop: w and the squared gradient cache are
+  updated in place, and the denominator is built in a scratch tensor kept in
+  the config.
+  config format: same as rmsprop, plus
+  - scratch: Reusable tensor of the same shape as w.
+  """
+  if config is None: config = {}
+  config.setdefault('learning_rate', 1e-2)
+  config.setdefault('decay_rate', 0.99)
+  config.setdefault('epsilon', 1e-8)
+  if 'cache' not in config:
+    config['cache'] = torch.zeros_like(w)
+  if 'scratch' not in config:
+    config['scratch'] = torch.empty_like(w)
+
+  cache, scratch = config['cache'], config['scratch']
+  cache.mul_(config['decay_rate']).addcmul_(dw, dw, value=1 - config['decay_rate'])
+  torch.sqrt(cache, out=scratch).add_(config['epsilon'])
+  w.addcdiv_(dw, scratch, value=-config['learning_rate'])
+
+  return w, config
+
+def adam_inplace(w, dw, config=None):
+  """
+  Allocation-free variant of adam: w, m and v are updated in place, and the
+  bias correction is folded into a scalar step size,
+
+    lr * m_unbias / (sqrt(v_unbias) + eps)
+      = (lr * sqrt(1 - beta2^t) / (1 - beta1^t)) * m / (sqrt(v) + eps * sqrt(1 - beta2^t))
+
+  so the denominator is the only tensor built per call, in a scratch tensor
+  kept in the config.
+  config format: same as adam, plus
+  - scratch: Reusable tensor of the same shape as w.
+  """
+  if config is None: config = {}
+  config.setdefault('learning_rate', 1e-3)
+  config.setdefault('beta1', 0.9)
+  config.setdefault('beta2', 0.999)
+  config.setdefault('epsilon', 1e-8)
+  config.setdefault('t', 0)
+  for k in ('m', 'v'):
+    if k not in config:
+      config[k] = torch.zeros_like(w)
+  if 'scratch' not in config:
+    config['scratch'] = torch.empty_like(w)
+
+  m, v, scratch = config['m'], config['v'], config['scratch']
+  config['t'] += 1
+  m.mul_(config['beta1']).add_(dw, alpha=1 - config['beta1'])
+  v.mul_(config['beta2']).addcmul_(dw, dw, value=1 - config['beta2'])
+
+  bias_correction1 = 1 - config['beta1'] ** config['t']
+  bias_correction2_sqrt = math.sqrt(1 - config['beta2'] ** config['t'])
+  step_size = config['learning_rate'] * bias_correction2_sqrt / bias_correction1
+  torch.sqrt(v, out=scratch).add_(config['epsilon'] * bias_correction2_sqrt)
+  w.addcdiv_(m, scratch, value=-step_size)
+
+  return w, config
+
 class Dropout(object):
 
   @staticmethod
@@ -16,46 +16,66 @@ def hello_helper():
   print('Hello from helper.py!')
 
 
-def get_CIFAR10_data(validation_ratio = 0.02, flatten=False):
+def get_CIFAR10_data(validation_ratio = 0.02, flatten=False, lazy=False,
+                     device=None, show_examples=False):
   """
   Load the CIFAR-10 dataset from disk and perform preprocessing to prepare
   it for the linear classifier. These are the same steps as we used for the
   SVM, but condensed to a single function.
+
+  All tensors are moved to device; None picks 'cuda' when it is available and
+  'cpu' otherwise. Set show_examples=True to plot a grid of sample images.
+
+  With lazy=True the images stay raw uint8 tensors and the returned dict has
+  a 'transform' spec instead, applied per minibatch by the Solver (see
+  utils.data.preprocess_cifar10).
   """
-  X_train, y_train, X_test, y_test = utils.data.cifar10()
+  X_train, y_train, X_test, y_test = utils.data.cifar10(
+    x_dtype=torch.uint8 if lazy else torch.float32)
 
-  # load every data on cuda
-  X_train = X_train.cuda()
-  y_train = y_train.cuda()
-  X_test = X_test.cuda()
-  y_test = y_test.cuda()
+  # load every data on the device
+  if device is None:
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+  X_train = X_train.to(device)
+  y_train = y_train.to(device)
+  X_test = X_test.to(device)
+  y_test = y_test.to(device)
 
   # 0. Visualize some examples from the dataset.
-  classes = [
-      'plane', 'car', 'bird', 'cat', 'deer',
-      'dog', 'frog', 'horse', 'ship', 'truck'
-  ]
-  samples_per_class = 12
-  samples = []
-  utils.reset_seed(0)
-  for y, cls in enumerate(classes):
-      plt.text(-4, 34 * y + 18, cls, ha='right')
-      idxs, = (y_train == y).nonzero(as_tuple=True)
-      for i in range(samples_per_class):
-          idx = idxs[random.randrange(idxs.shape[0])].item()
-          samples.append(X_train[idx])
-  img = torchvision.utils.make_grid(samples, nrow=samples_per_class)
-  plt.imshow(utils.tensor_to_image(img))
-  plt.axis('off')
-  plt.show()
+  if show_examples:
+    classes = [
+        'plane', 'car', 'bird', 'cat', 'deer',
+        'dog', 'frog', 'horse', 'ship', 'truck'
+    ]
+    samples_per_class = 12
+    # pick the sample indices on the CPU, then gather all images at once
+    y_cpu = y_train.cpu()
+    picks = []
+    utils.reset_seed(0)
+    for y, cls in enumerate(classes):
+        plt.text(-4, 34 * y + 18, cls, ha='right')
+        idxs = (y_cpu == y).nonzero(as_tuple=True)[0].tolist()
+        for i in range(samples_per_class):
+            picks.append(idxs[random.randrange(len(idxs))])
+    samples = X_train[torch.tensor(picks, device=X_train.device)].cpu()
+    if lazy:
+      samples = samples / 255
+    img = torchvision.utils.make_grid(samples, nrow=samples_per_class)
+    plt.imshow(utils.tensor_to_image(img))
+    plt.axis('off')
+    plt.show()
 
   # 1. Normalize the data: subtract the mean RGB (zero mean)
-  mean_image = X_train.mean(dim=0, keepdim=True).mean(dim=2, keepdim=True).mean(dim=3, keepdim=True)
-  X_train -= mean_image
-  X_test -= mean_image
+  if lazy:
+    transform = {'mean': utils.data.channel_mean(X_train), 'flatten': flatten,
+                 'bias_trick': False, 'dtype': torch.float32}
+  else:
+    mean_image = X_train.mean(dim=(0, 2, 3), keepdim=True)
+    X_train -= mean_image
+    X_test -= mean_image
 
   # 2. Reshape the image data into rows
-  if flatten:
+  if flatten and not lazy:
     X_train = X_train.reshape(X_train.shape[0], -1)
     X_test = X_test.reshape(X_test.shape[0], -1)
 
@@ -75,6 +95,8 @@ def get_CIFAR10_data(validation_ratio = 0.02, flatten=False):
 
   data_dict['X_test'] = X_test
   data_dict['y_test'] = y_test
+  if lazy:
+    data_dict['transform'] = transform
   return data_dict
 
 
@@ -1,4 +1,4 @@
-from . import data, grad
+from . import checkpoint, data, grad, optim, sweep
 from .solver import Solver
 from .general import reset_seed
 from .vis import tensor_to_image, visualize_dataset
@@ -0,0 +1,190 @@
+import json
+import os
+import queue
+import threading
+
+import torch
+
+
+"""
+Utilities to write training checkpoints without blocking the training loop
+"""
+
+
+def snapshot(obj):
+    """
+    Copy every tensor in a (possibly nested) dict / list / tuple to the CPU so
+    that the copy is unaffected by later in-place updates of the original.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def _atomic_save(obj, filename):
+    """
+    torch.save obj to a temporary file and rename it over filename, so a
+    reader never sees a partially written checkpoint.
+    """
+    tmp = filename + ".tmp"
+    torch.save(obj, tmp)
+    os.replace(tmp, filename)
+
+
+def read_history(checkpoint_name):
+    """
+    Rebuild the training histories appended by CheckpointWriter.
+
+    Inputs:
+    - checkpoint_name: Same prefix as passed to Solver(checkpoint_name=...)
+
+    Returns a dictionary with keys 'loss_history', 'train_acc_history' and
+    'val_acc_history'.
+    """
+    history = {"loss_history": [], "train_acc_history": [], "val_acc_history": []}
+    with open("%s_history.jsonl" % checkpoint_name) as f:
+        for line in f:
+            record = json.loads(line)
+            history["loss_history"].extend(record["loss_history"])
+            history["train_acc_history"].append(record["train_acc"])
+            history["val_acc_history"].append(record["val_acc"])
+    return history
+
+
+def load_checkpoint(path, model):
+    """
+    Restore a model from a checkpoint written by the Solver, e.g.
+    "<checkpoint_name>_best.pt". The saved params (and bn_params running
+    statistics, if the model has them) are copied into the model's existing
+    tensors, so they keep their device and dtype and any flat_update views
+    stay valid.
+
+    Inputs:
+    - path: Checkpoint file
+    - model: Model of the same architecture as the one that was trained
+
+    Returns the checkpoint dictionary, e.g. for its 'epoch' and
+    'best_val_acc' entries.
+    """
+    checkpoint = torch.load(path, map_location="cpu")
+    state = checkpoint["model"]
+    if set(state["params"]) != set(model.params):
+        raise ValueError(
+            "checkpoint params %s do not match model params %s"
+            % (sorted(state["params"]), sorted(model.params))
+        )
+    for k, v in state["params"].items():
+        model.params[k].copy_(v)
+
+    bn_params = getattr(model, "bn_params", None) or []
+    saved_bn_params = state.get("bn_params") or []
+    if len(bn_params) != len(saved_bn_params):
+        raise ValueError(
+            "checkpoint has %d bn_params but the model has %d"
+            % (len(saved_bn_params), len(bn_params))
+        )
+    device = next(iter(model.params.values())).device
+    for bn_param, saved in zip(bn_params, saved_bn_params):
+        for k, v in saved.items():
+            if torch.is_tensor(v) and torch.is_tensor(bn_param.get(k)):
+                bn_param[k].copy_(v)
+            else:
+                bn_param[k] = v.to(device) if torch.is_tensor(v) else v
+    return checkpoint
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints from a background thread.
+
+    Every submitted checkpoint is saved with torch.save to
+    "<checkpoint_name>_epoch_<epoch>.pt" (and to "<checkpoint_name>_best.pt"
+    when it is the best so far) through a temporary file and a rename. Only
+    the last `keep` epoch files are kept on disk. Histories are not stored in
+    the checkpoints; instead the new entries since the previous checkpoint
+    are appended as one JSON line to "<checkpoint_name>_history.jsonl".
+
+    The caller must pass tensors that will not be modified afterwards; use
+    snapshot() to take CPU copies.
+    """
+
+    def __init__(self, checkpoint_name, keep=3, append=False, verbose=True):
+        """
+        Inputs:
+        - checkpoint_name: Filename prefix for all checkpoint files
+        - keep: Number of most recent epoch checkpoints to keep; None keeps all
+        - append: Boolean; if False, start a new history file instead of
+          appending to an existing one
+        - verbose: Boolean; if True, print the name of every file written
+        """
+        history_file = "%s_history.jsonl" % checkpoint_name
+        if not append and os.path.exists(history_file):
+            os.remove(history_file)
+        self.checkpoint_name = checkpoint_name
+        self.keep = keep
+        self.verbose = verbose
+        self._written = []
+        self._error = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, epoch, state, history, is_best=False):
+        """
+        Queue a checkpoint for writing and return immediately.
+
+        Inputs:
+        - epoch: Integer epoch number used in the filename
+        - state: Dictionary to torch.save
+        - history: JSON-serializable dictionary appended to the history file
+        - is_best: Boolean; if True, also save state as the best checkpoint
+        """
+        self._raise_error()
+        self._queue.put((epoch, state, history, is_best))
+
+    def close(self):
+        """
+        Wait until every queued checkpoint is written and stop the thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+
+    def _write(self, epoch, state, history, is_best):
+        filename = "%s_epoch_%d.pt" % (self.checkpoint_name, epoch)
+        if self.verbose:
+            print('Saving checkpoint to "%s"' % filename)
+        _atomic_save(state, filename)
+        if is_best:
+            _atomic_save(state, "%s_best.pt" % self.checkpoint_name)
+        with open("%s_history.jsonl" % self.checkpoint_name, "a") as f:
+            f.write(json.dumps(history) + "\n")
+
+        if filename in self._written:
+            self._written.remove(filename)
+        self._written.append(filename)
+        while self.keep is not None and len(self._written) > self.keep:
+            old = self._written.pop(0)
+            if os.path.exists(old):
+                os.remove(old)
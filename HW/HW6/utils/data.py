@@ -2,6 +2,7 @@ import os
 import random
 
 import matplotlib.pyplot as plt
+import numpy as np
 import torch
 import torchvision
 from torchvision.datasets import CIFAR10
@@ -9,59 +10,159 @@ from torchvision.datasets import CIFAR10
 import utils
 
 
-def _extract_tensors(dset, num=None, x_dtype=torch.float32):
+def _extract_tensors(x, y, num=None, x_dtype=torch.float32):
     """
-    Extract the data and labels from a CIFAR10 dataset object and convert them to
-    tensors.
+    Subsample the uint8 images and labels of one CIFAR10 split and convert the
+    images to x_dtype.
 
     Input:
-    - dset: A torchvision.datasets.CIFAR10 object
+    - x: uint8 tensor of shape (N, 3, 32, 32), e.g. memory-mapped from the cache
+    - y: int64 tensor of shape (N,)
     - num: Optional. If provided, the number of samples to keep.
-    - x_dtype: Optional. data type of the input image
+    - x_dtype: Optional. data type of the input image. torch.uint8 returns the
+      raw pixels without copying them; any other dtype is scaled to [0, 1].
 
     Returns:
     - x: `x_dtype` tensor of shape (N, 3, 32, 32)
     - y: int64 tensor of shape (N,)
     """
-    x = torch.tensor(dset.data, dtype=x_dtype).permute(0, 3, 1, 2).div_(255)
-    y = torch.tensor(dset.targets, dtype=torch.int64)
     if num is not None:
         if num <= 0 or num > x.shape[0]:
             raise ValueError(
                 "Invalid value num=%d; must be in the range [0, %d]" % (num, x.shape[0])
             )
-        x = x[:num].clone()
-        y = y[:num].clone()
+        x = x[:num]
+        y = y[:num]
+    if x_dtype != torch.uint8:
+        # a single copy of only the kept samples
+        x = x.to(x_dtype).div_(255)
+    return x, y.clone()
+
+
+def _cache_files(cache_dir, split):
+    return (
+        os.path.join(cache_dir, "%s_x.npy" % split),
+        os.path.join(cache_dir, "%s_y.npy" % split),
+    )
+
+
+def build_cifar10_cache(cache_dir="cifar-10-uint8"):
+    """
+    One-time conversion of CIFAR10 (downloaded if necessary) to uint8 .npy
+    files that cifar10() memory-maps: "<split>_x.npy" with the images in
+    NCHW layout and "<split>_y.npy" with int64 labels, for split in
+    ("train", "test").
+
+    Inputs:
+    - cache_dir: Directory to write the files to
+    """
+    download = not os.path.isdir("cifar-10-batches-py")
+    os.makedirs(cache_dir, exist_ok=True)
+    for split in ("train", "test"):
+        dset = CIFAR10(root=".", download=download, train=(split == "train"))
+        x = np.ascontiguousarray(dset.data.transpose(0, 3, 1, 2))
+        y = np.asarray(dset.targets, dtype=np.int64)
+        for filename, arr in zip(_cache_files(cache_dir, split), (x, y)):
+            # np.save appends .npy to names that lack it
+            tmp = filename[:-len(".npy")] + ".tmp.npy"
+            np.save(tmp, arr)
+            os.replace(tmp, filename)
+
+
+def _load_cached(cache_dir, split):
+    """
+    Memory-map one split of the cache as uint8 / int64 tensors. The mapping is
+    copy-on-write, so pages are only read from disk when they are accessed and
+    the tensors can still be written to without touching the files.
+    """
+    x_file, y_file = _cache_files(cache_dir, split)
+    x = torch.from_numpy(np.load(x_file, mmap_mode="c"))
+    y = torch.from_numpy(np.load(y_file))
     return x, y
 
 
-def cifar10(num_train=None, num_test=None, x_dtype=torch.float32):
+def cifar10(num_train=None, num_test=None, x_dtype=torch.float32,
+            cache_dir="cifar-10-uint8"):
     """
     Return the CIFAR10 dataset, automatically downloading it if necessary.
     This function can also subsample the dataset.
 
+    The first call converts the dataset to a uint8 cache with
+    build_cifar10_cache; later calls memory-map the cache instead of
+    unpickling the torchvision batches.
+
     Inputs:
     - num_train: [Optional] How many samples to keep from the training set.
       If not provided, then keep the entire training set.
     - num_test: [Optional] How many samples to keep from the test set.
       If not provided, then keep the entire test set.
-    - x_dtype: [Optional] Data type of the input image
+    - x_dtype: [Optional] Data type of the input image. With torch.uint8 the
+      images are returned as raw memory-mapped pixels in [0, 255].
+    - cache_dir: [Optional] Directory of the uint8 cache
 
     Returns:
     - x_train: `x_dtype` tensor of shape (num_train, 3, 32, 32)
-    - y_train: int64 tensor of shape (num_train, 3, 32, 32)
+    - y_train: int64 tensor of shape (num_train,)
     - x_test: `x_dtype` tensor of shape (num_test, 3, 32, 32)
-    - y_test: int64 tensor of shape (num_test, 3, 32, 32)
+    - y_test: int64 tensor of shape (num_test,)
     """
-    download = not os.path.isdir("cifar-10-batches-py")
-    dset_train = CIFAR10(root=".", download=download, train=True)
-    dset_test = CIFAR10(root=".", train=False)
-    x_train, y_train = _extract_tensors(dset_train, num_train, x_dtype)
-    x_test, y_test = _extract_tensors(dset_test, num_test, x_dtype)
+    if not all(os.path.exists(f) for split in ("train", "test")
+               for f in _cache_files(cache_dir, split)):
+        build_cifar10_cache(cache_dir)
+    x_train, y_train = _extract_tensors(*_load_cached(cache_dir, "train"), num_train, x_dtype)
+    x_test, y_test = _extract_tensors(*_load_cached(cache_dir, "test"), num_test, x_dtype)
 
     return x_train, y_train, x_test, y_test
 
 
+def channel_mean(X, dtype=torch.float32, chunk_size=5000):
+    """
+    Per-channel mean of a uint8 image tensor, scaled to [0, 1], computed chunk
+    by chunk so that no float copy of the whole tensor is made.
+
+    Inputs:
+    - X: uint8 tensor of shape (N, C, H, W)
+    - dtype: Data type of the result
+    - chunk_size: Number of images converted to float at a time
+
+    Returns:
+    - mean: `dtype` tensor of shape (1, C, 1, 1) on the device of X
+    """
+    total = torch.zeros(X.shape[1], dtype=torch.float64, device=X.device)
+    for start in range(0, X.shape[0], chunk_size):
+        total += X[start : start + chunk_size].sum(dim=(0, 2, 3), dtype=torch.float64)
+    count = X.shape[0] * X.shape[2] * X.shape[3]
+    return (total / (255 * count)).to(dtype).view(1, -1, 1, 1)
+
+
+def apply_transform(X, transform):
+    """
+    Turn a batch of raw uint8 images into model inputs, following the
+    transform spec of a lazy data dictionary (see preprocess_cifar10). Called
+    by the Solver on every minibatch, so only one batch at a time is ever
+    held as floats.
+
+    Inputs:
+    - X: uint8 tensor of shape (N, 3, 32, 32)
+    - transform: Dictionary with keys
+      - 'mean': Tensor of shape (1, 3, 1, 1) subtracted after scaling to [0, 1]
+      - 'flatten': Boolean; reshape each image into a row
+      - 'bias_trick': Boolean; append a column of ones (implies flatten)
+      - 'dtype': Data type of the result
+
+    Returns:
+    - X: `dtype` tensor on the device of X, of shape (N, 3, 32, 32), or
+      (N, D) if flattened
+    """
+    X = X.to(transform["dtype"]).div_(255)
+    X -= transform["mean"].to(X.device)
+    if transform["flatten"] or transform["bias_trick"]:
+        X = X.reshape(X.shape[0], -1)
+    if transform["bias_trick"]:
+        X = torch.cat([X, X.new_ones(X.shape[0], 1)], dim=1)
+    return X
+
+
 def preprocess_cifar10(
     cuda=True,
     show_examples=True,
@@ -69,6 +170,7 @@ def preprocess_cifar10(
     flatten=True,
     validation_ratio=0.2,
     dtype=torch.float32,
+    lazy=False,
 ):
     """
     Returns a preprocessed version of the CIFAR10 dataset, automatically
@@ -87,6 +189,10 @@ def preprocess_cifar10(
     - bias_trick: Boolean telling whether or not to apply the bias trick
     - show_examples: Boolean telling whether or not to visualize data samples
     - dtype: Optional, data type of the input image X
+    - lazy: If true, keep the images as raw uint8 tensors (memory-mapped on
+      the CPU) and return the normalization as a transform spec instead of
+      applying it; steps (1) to (3) then happen per minibatch in
+      apply_transform, which the Solver calls on every batch it draws
 
     Returns a dictionary with the following keys:
     - 'X_train': `dtype` tensor of shape (N_train, D) giving training images
@@ -95,6 +201,8 @@ def preprocess_cifar10(
     - 'y_train': int64 tensor of shape (N_train,) giving training labels
     - 'y_val': int64 tensor of shape (N_val,) giving val labels
     - 'y_test': int64 tensor of shape (N_test,) giving test labels
+    - 'transform': Only if lazy; the spec for apply_transform. X_train,
+      X_val and X_test are then uint8 tensors of shape (N, 3, 32, 32)
 
     N_train, N_val, and N_test are the number of examples in the train, val, and
     test sets respectively. The precise values of N_train and N_val are determined
@@ -102,7 +210,7 @@ def preprocess_cifar10(
     if bias_trick is False, then D = 32 * 32 * 3 = 3072;
     if bias_trick is True then D = 1 + 32 * 32 * 3 = 3073.
     """
-    X_train, y_train, X_test, y_test = cifar10(x_dtype=dtype)
+    X_train, y_train, X_test, y_test = cifar10(x_dtype=torch.uint8 if lazy else dtype)
 
     # Move data to the GPU
     if cuda:
@@ -133,16 +241,26 @@ def preprocess_cifar10(
             (idxs,) = (y_train == y).nonzero(as_tuple=True)
             for i in range(samples_per_class):
                 idx = idxs[random.randrange(idxs.shape[0])].item()
-                samples.append(X_train[idx])
+                sample = X_train[idx]
+                samples.append(sample.to(dtype) / 255 if lazy else sample)
         img = torchvision.utils.make_grid(samples, nrow=samples_per_class)
         plt.imshow(utils.tensor_to_image(img))
         plt.axis("off")
         plt.show()
 
     # 1. Normalize the data: subtract the mean RGB (zero mean)
-    mean_image = X_train.mean(dim=(0, 2, 3), keepdim=True)
-    X_train -= mean_image
-    X_test -= mean_image
+    if lazy:
+        transform = {
+            "mean": channel_mean(X_train, dtype),
+            "flatten": flatten,
+            "bias_trick": bias_trick,
+            "dtype": dtype,
+        }
+        flatten = bias_trick = False
+    else:
+        mean_image = X_train.mean(dim=(0, 2, 3), keepdim=True)
+        X_train -= mean_image
+        X_test -= mean_image
 
     # 2. Reshape the image data into rows
     if flatten:
@@ -172,4 +290,6 @@ def preprocess_cifar10(
 
     data_dict["X_test"] = X_test
     data_dict["y_test"] = y_test
+    if lazy:
+        data_dict["transform"] = transform
     return data_dict
@@ -0,0 +1,68 @@
+import torch
+
+
+"""
+Utilities to run update rules over all parameters of a model at once
+"""
+
+
+class FlatParams(object):
+    """
+    Packs a dictionary of parameter tensors into one contiguous flat buffer and
+    rebinds every entry of the dictionary to a view into it. A second flat
+    buffer of the same size holds the gradients, so an elementwise update rule
+    (sgd, sgd_momentum, rmsprop, adam, ...) can be applied to every parameter
+    with a single call, giving bit-identical results to calling it once per
+    tensor.
+
+    All parameters must share the same dtype and device.
+    """
+
+    def __init__(self, params):
+        """
+        Inputs:
+        - params: Dictionary mapping parameter names to tensors, e.g.
+          model.params. Its values are replaced in place by views into
+          self.params.
+        """
+        if len(params) == 0:
+            raise ValueError("FlatParams needs at least one parameter")
+        first = next(iter(params.values()))
+        for k, v in params.items():
+            if v.dtype != first.dtype or v.device != first.device:
+                raise ValueError(
+                    'param "%s" has dtype %r and device %r; expected %r and %r'
+                    % (k, v.dtype, v.device, first.dtype, first.device)
+                )
+
+        self.keys = list(params.keys())
+        self.shapes = [params[k].shape for k in self.keys]
+        self.numels = [params[k].numel() for k in self.keys]
+
+        self.params = torch.cat([params[k].detach().reshape(-1) for k in self.keys])
+        self.grads = torch.zeros_like(self.params)
+        self._grad_views = self.unflatten(self.grads)
+        for k, v in self.unflatten(self.params).items():
+            params[k] = v
+
+    def unflatten(self, flat):
+        """
+        Split a flat tensor laid out like self.params into a dictionary of
+        views with the original parameter shapes.
+        """
+        chunks = flat.split(self.numels)
+        return {k: c.view(s) for k, c, s in zip(self.keys, chunks, self.shapes)}
+
+    def pack_grads(self, grads):
+        """
+        Copy a dictionary of gradients into the flat gradient buffer.
+
+        Inputs:
+        - grads: Dictionary with the same keys as the packed parameters
+
+        Returns:
+        - self.grads, the flat gradient buffer
+        """
+        for k in self.keys:
+            self._grad_views[k].copy_(grads[k])
+        return self.grads
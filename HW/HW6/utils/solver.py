@@ -1,8 +1,13 @@
-import pickle
+import queue
+import threading
 import time
 
 import torch
 
+from .checkpoint import CheckpointWriter, snapshot
+from .data import apply_transform
+from .optim import FlatParams
+
 
 class Solver(object):
     """
@@ -72,17 +77,42 @@ class Solver(object):
           'X_val': Array, shape (N_val, d_1, ..., d_k) of validation images
           'y_train': Array, shape (N_train,) of labels for training images
           'y_val': Array, shape (N_val,) of labels for validation images
+          and optionally
+          'transform': Spec from preprocess_cifar10(lazy=True); the images
+          are then raw uint8 tensors and every minibatch (also in
+          check_accuracy) goes through utils.data.apply_transform once it is
+          on self.device
         Optional arguments:
         - update_rule: A function of an update rule. Default is sgd.
         - optim_config: A dictionary containing hyperparameters that will be
           passed to the chosen update rule. Each update rule requires different
           hyperparameters but all update rules require a
           'learning_rate' parameter so that should always be present.
+        - flat_update: Boolean; if True, pack all of model.params into one
+          contiguous buffer (model.params then holds views into it) and call
+          the update rule once per step on the flat parameters and gradients
+          instead of once per tensor. Requires all params to share a dtype and
+          device; results are bit-identical for elementwise update rules.
         - lr_decay: A scalar for learning rate decay; after each epoch the
           learning rate is multiplied by this value.
         - batch_size: Size of minibatches used to compute loss and gradient
           during training.
         - num_epochs: The number of epochs to run for during training.
+        - patience: If not None, stop training early once the validation
+          accuracy has not improved for this many consecutive epochs. Only the
+          checks at the end of an epoch count; the extra checks at the first
+          and last iteration can set a new best but never use up patience.
+        - sampler: How minibatches are drawn from the training set. 'epoch'
+          (default) shuffles once per epoch and walks the permutation in
+          contiguous slices, so every sample is seen exactly once per epoch;
+          'random' draws each minibatch independently (with replacement
+          across minibatches).
+        - prefetch: Number of minibatches to build ahead of time in a background
+          thread; 0 (default) builds each minibatch on demand. When the data
+          lives on the CPU and device is a GPU, prefetched batches are copied
+          from pinned memory with non-blocking transfers. The thread samples
+          minibatches with its own torch.Generator, seeded from the global
+          RNG when train() starts, so fixed-seed runs stay reproducible.
         - print_every: Integer; training losses will be printed every
           print_every iterations.
         - print_acc_every: We will print the accuracy every print_acc_every epochs.
@@ -93,26 +123,43 @@ class Solver(object):
         - num_val_samples: Number of validation samples to use to check val
           accuracy; default is None, which uses the entire validation set.
         - checkpoint_name: If not None, then save model checkpoints here every
-          epoch.
+          epoch. Checkpoints are written from a background thread with
+          torch.save to "<checkpoint_name>_epoch_<epoch>.pt", plus
+          "<checkpoint_name>_best.pt" for the best validation accuracy, and the
+          histories are appended to "<checkpoint_name>_history.jsonl".
+        - checkpoint_keep: Number of most recent epoch checkpoints to keep on
+          disk; default is 3; set to None to keep all of them.
+        - best_params_device: Device holding the copy of the best parameters;
+          default is None, which keeps it next to model.params. Set to 'cpu' to
+          spill it out of GPU memory (with checkpoint_name set, the best
+          parameters are also on disk in "<checkpoint_name>_best.pt", which
+          utils.checkpoint.load_checkpoint restores into a model).
         """
         self.model = model
         self.X_train = data["X_train"]
         self.y_train = data["y_train"]
         self.X_val = data["X_val"]
         self.y_val = data["y_val"]
+        self.transform = data.get("transform")
 
         # Unpack keyword arguments
         self.update_rule = kwargs.pop("update_rule", self.sgd)
         self.optim_config = kwargs.pop("optim_config", {})
+        self.flat_update = kwargs.pop("flat_update", False)
         self.lr_decay = kwargs.pop("lr_decay", 1.0)
         self.batch_size = kwargs.pop("batch_size", 100)
         self.num_epochs = kwargs.pop("num_epochs", 10)
+        self.patience = kwargs.pop("patience", None)
+        self.sampler = kwargs.pop("sampler", "epoch")
         self.num_train_samples = kwargs.pop("num_train_samples", 1000)
         self.num_val_samples = kwargs.pop("num_val_samples", None)
 
         self.device = kwargs.pop("device", "cpu")
+        self.prefetch = kwargs.pop("prefetch", 0)
 
         self.checkpoint_name = kwargs.pop("checkpoint_name", None)
+        self.checkpoint_keep = kwargs.pop("checkpoint_keep", 3)
+        self.best_params_device = kwargs.pop("best_params_device", None)
         self.print_every = kwargs.pop("print_every", 10)
         self.print_acc_every = kwargs.pop("print_acc_every", 1)
         self.verbose = kwargs.pop("verbose", True)
@@ -121,6 +168,8 @@ class Solver(object):
         if len(kwargs) > 0:
             extra = ", ".join('"%s"' % k for k in list(kwargs.keys()))
             raise ValueError("Unrecognized arguments %s" % extra)
+        if self.sampler not in ("epoch", "random"):
+            raise ValueError('Invalid sampler "%s"' % self.sampler)
 
         self._reset()
 
@@ -133,26 +182,168 @@ class Solver(object):
         self.epoch = 0
         self.best_val_acc = 0
         self.best_params = {}
+        self.num_bad_epochs = 0
         self.loss_history = []
         self.train_acc_history = []
         self.val_acc_history = []
 
-        # Make a deep copy of the optim_config for each parameter
+        # Sampler state: the current epoch permutation and our position in it
+        self._epoch_order = None
+        self._epoch_cursor = 0
+
+        # Prefetch state; wait_time is the total time train() spent blocked on
+        # the queue and queue_depth the number of ready batches at each request
+        self._prefetch_queue = None
+        self._prefetch_stop = None
+        self._prefetch_thread = None
+        self._prefetch_generator = None
+        self._prefetch_sampler_state = None
+        self.prefetch_stats = {"wait_time": 0.0, "queue_depth": []}
+
+        # Device-resident evaluation subsets used by check_accuracy
+        self._eval_subsets = {}
+
+        # Checkpoint writer, and how much of loss_history has been written
+        self._checkpoint_writer = None
+        self._num_losses_saved = 0
+
+        # Make a deep copy of the optim_config for each parameter; with
+        # flat_update a single config covers the whole flat buffer
+        self._flat = None
         self.optim_configs = {}
-        for p in self.model.params:
+        param_names = ["_flat"] if self.flat_update else self.model.params
+        for p in param_names:
             d = {k: v for k, v in self.optim_config.items()}
             self.optim_configs[p] = d
 
+    def _sample_batch(self):
+        """
+        Return the indices of the next minibatch, on the device where the
+        training data lives so that the gather happens there.
+        """
+        num_train = self.X_train.shape[0]
+        device = self.X_train.device
+        # None (the global RNG) unless called from the prefetch thread
+        generator = self._prefetch_generator
+        if self.sampler == "random":
+            return torch.randperm(num_train, device=device, generator=generator)[
+                : self.batch_size
+            ]
+
+        # Reshuffle once the current permutation cannot fill another minibatch;
+        # the leftover tail (fewer than batch_size samples) is dropped.
+        end = self._epoch_cursor + self.batch_size
+        if self._epoch_order is None or end > num_train:
+            self._epoch_order = torch.randperm(num_train, device=device, generator=generator)
+            self._epoch_cursor, end = 0, self.batch_size
+        batch_mask = self._epoch_order[self._epoch_cursor : end]
+        self._epoch_cursor = end
+        return batch_mask
+
+    def _to_device(self, x):
+        """
+        Move a minibatch tensor to self.device. Prefetched CPU batches headed
+        for a GPU go through pinned memory so the copy can be asynchronous.
+        """
+        device = torch.device(self.device)
+        if self.prefetch and x.device.type == "cpu" and device.type == "cuda":
+            return x.pin_memory().to(device, non_blocking=True)
+        return x.to(device)
+
+    def _make_batch(self):
+        """
+        Gather the next minibatch and move it to self.device.
+        """
+        batch_mask = self._sample_batch()
+        X_batch = self.X_train[batch_mask]
+        y_batch = self.y_train[batch_mask.to(self.y_train.device)]
+        return self._transform(self._to_device(X_batch)), self._to_device(y_batch)
+
+    def _transform(self, X):
+        """
+        Apply the lazy data transform, if any, to a minibatch on self.device.
+        """
+        if self.transform is None:
+            return X
+        return apply_transform(X, self.transform)
+
+    def _prefetch_worker(self, batches, stop):
+        """
+        Body of the prefetch thread: keep the bounded queue full until stopped.
+        Every batch is queued together with the sampler state right after it,
+        so that _stop_prefetch can rewind past the batches never consumed.
+        Exceptions are handed to the training loop through the queue.
+        """
+        while not stop.is_set():
+            try:
+                batch = (self._make_batch(), (self._epoch_order, self._epoch_cursor))
+            except Exception as e:
+                batch = e
+            while not stop.is_set():
+                try:
+                    batches.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(batch, Exception):
+                return
+
+    def _start_prefetch(self):
+        if not self.prefetch:
+            return
+        self._stop_prefetch()
+        # Seed the thread's generator from the global RNG, on the main thread,
+        # so that the draw happens at the same point in every run
+        seed = torch.randint(2**62, (1,)).item()
+        self._prefetch_generator = torch.Generator(device=self.X_train.device)
+        self._prefetch_generator.manual_seed(seed)
+        self._prefetch_sampler_state = (self._epoch_order, self._epoch_cursor)
+        self._prefetch_queue = queue.Queue(maxsize=self.prefetch)
+        self._prefetch_stop = threading.Event()
+        self._prefetch_thread = threading.Thread(
+            target=self._prefetch_worker,
+            args=(self._prefetch_queue, self._prefetch_stop),
+            daemon=True,
+        )
+        self._prefetch_thread.start()
+
+    def _stop_prefetch(self):
+        if self._prefetch_thread is None:
+            return
+        self._prefetch_stop.set()
+        self._prefetch_thread.join()
+        # Batches still queued are dropped; rewind the sampler to just after
+        # the last consumed one so that their samples are not skipped
+        self._epoch_order, self._epoch_cursor = self._prefetch_sampler_state
+        self._prefetch_queue = None
+        self._prefetch_stop = None
+        self._prefetch_thread = None
+        self._prefetch_generator = None
+        self._prefetch_sampler_state = None
+
+    def _next_batch(self):
+        """
+        Return the next (X_batch, y_batch), from the prefetch queue when the
+        background thread is running.
+        """
+        if self._prefetch_thread is None:
+            return self._make_batch()
+        self.prefetch_stats["queue_depth"].append(self._prefetch_queue.qsize())
+        start = time.time()
+        item = self._prefetch_queue.get()
+        self.prefetch_stats["wait_time"] += time.time() - start
+        if isinstance(item, Exception):
+            raise item
+        batch, self._prefetch_sampler_state = item
+        return batch
+
     def _step(self):
         """
         Make a single gradient update. This is called by train() and should not
         be called manually.
         """
         # Make a minibatch of training data
-        num_train = self.X_train.shape[0]
-        batch_mask = torch.randperm(num_train)[: self.batch_size]
-        X_batch = self.X_train[batch_mask].to(self.device)
-        y_batch = self.y_train[batch_mask].to(self.device)
+        X_batch, y_batch = self._next_batch()
 
         # Compute loss and gradient
         loss, grads = self.model.loss(X_batch, y_batch)
@@ -160,34 +351,79 @@ class Solver(object):
 
         # Perform a parameter update
         with torch.no_grad():
-            for p, w in self.model.params.items():
-                dw = grads[p]
-                config = self.optim_configs[p]
-                next_w, next_config = self.update_rule(w, dw, config)
-                self.model.params[p] = next_w
-                self.optim_configs[p] = next_config
-
-    def _save_checkpoint(self):
-        if self.checkpoint_name is None:
+            if self._flat is not None:
+                dw = self._flat.pack_grads(grads)
+                config = self.optim_configs["_flat"]
+                next_w, next_config = self.update_rule(self._flat.params, dw, config)
+                if next_w is not self._flat.params:
+                    self._flat.params.copy_(next_w)
+                self.optim_configs["_flat"] = next_config
+            else:
+                for p, w in self.model.params.items():
+                    dw = grads[p]
+                    config = self.optim_configs[p]
+                    next_w, next_config = self.update_rule(w, dw, config)
+                    self.model.params[p] = next_w
+                    self.optim_configs[p] = next_config
+
+    def _update_best_params(self):
+        """
+        Copy model.params into self.best_params. The buffers are allocated on
+        the first improvement and overwritten in place afterwards.
+        """
+        params = self.model.params
+        same_layout = self.best_params.keys() == params.keys() and all(
+            self.best_params[k].shape == v.shape for k, v in params.items()
+        )
+        if not same_layout:
+            self.best_params = {}
+            for k, v in params.items():
+                device = self.best_params_device or v.device
+                self.best_params[k] = torch.empty_like(v, device=device)
+        for k, v in params.items():
+            self.best_params[k].copy_(v)
+
+    def _save_checkpoint(self, is_best=False):
+        """
+        Snapshot the model to the CPU and hand it to the background writer;
+        only the losses recorded since the previous checkpoint are written.
+        """
+        if self._checkpoint_writer is None:
             return
         checkpoint = {
-            "model": self.model,
-            "update_rule": self.update_rule,
+            "model": snapshot(vars(self.model)),
+            "update_rule": getattr(self.update_rule, "__name__", repr(self.update_rule)),
             "lr_decay": self.lr_decay,
             "optim_config": self.optim_config,
             "batch_size": self.batch_size,
             "num_train_samples": self.num_train_samples,
             "num_val_samples": self.num_val_samples,
             "epoch": self.epoch,
-            "loss_history": self.loss_history,
-            "train_acc_history": self.train_acc_history,
-            "val_acc_history": self.val_acc_history,
+            "best_val_acc": self.best_val_acc,
         }
-        filename = "%s_epoch_%d.pkl" % (self.checkpoint_name, self.epoch)
-        if self.verbose:
-            print('Saving checkpoint to "%s"' % filename)
-        with open(filename, "wb") as f:
-            pickle.dump(checkpoint, f)
+        history = {
+            "epoch": self.epoch,
+            "loss_history": self.loss_history[self._num_losses_saved :],
+            "train_acc": self.train_acc_history[-1],
+            "val_acc": self.val_acc_history[-1],
+        }
+        self._num_losses_saved = len(self.loss_history)
+        self._checkpoint_writer.submit(self.epoch, checkpoint, history, is_best)
+
+    def _close_checkpoint_writer(self, raise_errors=True):
+        """
+        Wait for the queued checkpoints and stop the writer thread. With
+        raise_errors False, a write error is printed instead of raised.
+        """
+        if self._checkpoint_writer is None:
+            return
+        writer, self._checkpoint_writer = self._checkpoint_writer, None
+        try:
+            writer.close()
+        except Exception as e:
+            if raise_errors:
+                raise
+            print("Failed to write checkpoints: %r" % (e,))
 
     @staticmethod
     def sgd(w, dw, config=None):
@@ -203,6 +439,29 @@ class Solver(object):
         w -= config["learning_rate"] * dw
         return w, config
 
+    def _eval_subset(self, X, y, num_samples):
+        """
+        Return the evaluation subset of (X, y) on self.device. The subset is
+        drawn on first use and reused by later calls, so accuracies from
+        different epochs are measured on the same samples.
+        """
+        key = (id(X), num_samples)
+        cached = self._eval_subsets.get(key)
+        if cached is not None and cached[0] is X and cached[1] is y:
+            return cached[2], cached[3]
+
+        # Maybe subsample the data
+        X_eval, y_eval = X, y
+        N = X.shape[0]
+        if num_samples is not None and N > num_samples:
+            mask = torch.randperm(N, device=X.device)[:num_samples]
+            X_eval = X[mask]
+            y_eval = y[mask.to(y.device)]
+        X_eval = X_eval.to(self.device)
+        y_eval = y_eval.to(self.device)
+        self._eval_subsets[key] = (X, y, X_eval, y_eval)
+        return X_eval, y_eval
+
     def check_accuracy(self, X, y, num_samples=None, batch_size=100):
         """
         Check accuracy of the model on the provided data.
@@ -210,39 +469,27 @@ class Solver(object):
         - X: Array of data, of shape (N, d_1, ..., d_k)
         - y: Array of labels, of shape (N,)
         - num_samples: If not None, subsample the data and only test the model
-          on num_samples datapoints.
+          on num_samples datapoints. The subsample is drawn once per (X,
+          num_samples) and reused by later calls.
         - batch_size: Split X and y into batches of this size to avoid using
           too much memory.
         Returns:
         - acc: Scalar giving the fraction of instances that were correctly
           classified by the model.
         """
-
-        # Maybe subsample the data
+        X, y = self._eval_subset(X, y, num_samples)
         N = X.shape[0]
-        if num_samples is not None and N > num_samples:
-            mask = torch.randperm(N, device=self.device)[:num_samples]
-            N = num_samples
-            X = X[mask]
-            y = y[mask]
-        X = X.to(self.device)
-        y = y.to(self.device)
-
-        # Compute predictions in batches
-        num_batches = N // batch_size
-        if N % batch_size != 0:
-            num_batches += 1
-        y_pred = []
-        for i in range(num_batches):
-            start = i * batch_size
-            end = (i + 1) * batch_size
-            scores = self.model.loss(X[start:end])
-            y_pred.append(torch.argmax(scores, dim=1))
-
-        y_pred = torch.cat(y_pred)
-        acc = (y_pred == y).to(torch.float).mean()
-
-        return acc.item()
+
+        # Count correct predictions batch by batch; the count stays on the
+        # device so there is a single sync at the end
+        with torch.inference_mode():
+            num_correct = torch.zeros((), dtype=torch.int64, device=y.device)
+            for start in range(0, N, batch_size):
+                end = start + batch_size
+                scores = self.model.loss(self._transform(X[start:end]))
+                num_correct += (torch.argmax(scores, dim=1) == y[start:end]).sum()
+
+        return num_correct.item() / N
 
     def train(self, time_limit=None, return_best_params=True):
         """
@@ -253,73 +500,105 @@ class Solver(object):
         num_iterations = self.num_epochs * iterations_per_epoch
         prev_time = start_time = time.time()
 
-        for t in range(num_iterations):
+        # (Re)pack the params, since model.params may have been swapped out
+        # since the last call
+        if self.flat_update:
+            self._flat = FlatParams(self.model.params)
+
+        if self.checkpoint_name is not None:
+            self._checkpoint_writer = CheckpointWriter(
+                self.checkpoint_name,
+                keep=self.checkpoint_keep,
+                append=self._num_losses_saved > 0,
+                verbose=self.verbose,
+            )
+        self._start_prefetch()
+        completed = False
+        try:
+            for t in range(num_iterations):
+
+                cur_time = time.time()
+                if (time_limit is not None) and (t > 0):
+                    next_time = cur_time - prev_time
+                    if cur_time - start_time + next_time > time_limit:
+                        print(
+                            "(Time %.2f sec; Iteration %d / %d) loss: %f"
+                            % (
+                                cur_time - start_time,
+                                t,
+                                num_iterations,
+                                self.loss_history[-1],
+                            )
+                        )
+                        print("End of training; next iteration will exceed the time limit.")
+                        break
+                prev_time = cur_time
+
+                self._step()
 
-            cur_time = time.time()
-            if (time_limit is not None) and (t > 0):
-                next_time = cur_time - prev_time
-                if cur_time - start_time + next_time > time_limit:
+                # Maybe print training loss
+                if self.verbose and t % self.print_every == 0:
                     print(
                         "(Time %.2f sec; Iteration %d / %d) loss: %f"
                         % (
-                            cur_time - start_time,
-                            t,
+                            time.time() - start_time,
+                            t + 1,
                             num_iterations,
                             self.loss_history[-1],
                         )
                     )
-                    print("End of training; next iteration will exceed the time limit.")
-                    break
-            prev_time = cur_time
-
-            self._step()
-
-            # Maybe print training loss
-            if self.verbose and t % self.print_every == 0:
-                print(
-                    "(Time %.2f sec; Iteration %d / %d) loss: %f"
-                    % (
-                        time.time() - start_time,
-                        t + 1,
-                        num_iterations,
-                        self.loss_history[-1],
-                    )
-                )
-
-            # At the end of every epoch, increment the epoch counter and decay
-            # the learning rate.
-            epoch_end = (t + 1) % iterations_per_epoch == 0
-            if epoch_end:
-                self.epoch += 1
-                for k in self.optim_configs:
-                    self.optim_configs[k]["learning_rate"] *= self.lr_decay
-
-            # Check train and val accuracy on the first iteration, the last
-            # iteration, and at the end of each epoch.
-            with torch.no_grad():
-                first_it = t == 0
-                last_it = t == num_iterations - 1
-                if first_it or last_it or epoch_end:
-                    train_acc = self.check_accuracy(
-                        self.X_train, self.y_train, num_samples=self.num_train_samples
-                    )
-                    val_acc = self.check_accuracy(
-                        self.X_val, self.y_val, num_samples=self.num_val_samples
-                    )
-                    self.train_acc_history.append(train_acc)
-                    self.val_acc_history.append(val_acc)
-                    self._save_checkpoint()
-
-                    if self.verbose and self.epoch % self.print_acc_every == 0:
-                        print(f'(Epoch {self.epoch} / {self.num_epochs}) train acc: {"{:.2f}".format(train_acc*100)}%; val_acc: {"{:.2f}".format(val_acc*100)}%')
-
-                    # Keep track of the best model
-                    if val_acc > self.best_val_acc:
-                        self.best_val_acc = val_acc
-                        self.best_params = {}
-                        for k, v in self.model.params.items():
-                            self.best_params[k] = v.clone()
-
-        # At the end of training swap the best params into the model
-        if return_best_params:
-          self.model.params = self.best_params
+
+                # At the end of every epoch, increment the epoch counter and decay
+                # the learning rate.
+                epoch_end = (t + 1) % iterations_per_epoch == 0
+                if epoch_end:
+                    self.epoch += 1
+                    for k in self.optim_configs:
+                        self.optim_configs[k]["learning_rate"] *= self.lr_decay
+
+                # Check train and val accuracy on the first iteration, the last
+                # iteration, and at the end of each epoch.
+                with torch.no_grad():
+                    first_it = t == 0
+                    last_it = t == num_iterations - 1
+                    if first_it or last_it or epoch_end:
+                        train_acc = self.check_accuracy(
+                            self.X_train, self.y_train, num_samples=self.num_train_samples
+                        )
+                        val_acc = self.check_accuracy(
+                            self.X_val, self.y_val, num_samples=self.num_val_samples
+                        )
+                        self.train_acc_history.append(train_acc)
+                        self.val_acc_history.append(val_acc)
+
+                        if self.verbose and self.epoch % self.print_acc_every == 0:
+                            print(f'(Epoch {self.epoch} / {self.num_epochs}) train acc: {"{:.2f}".format(train_acc*100)}%; val_acc: {"{:.2f}".format(val_acc*100)}%')
+
+                        # Keep track of the best model
+                        is_best = val_acc > self.best_val_acc
+                        if is_best:
+                            self.best_val_acc = val_acc
+                            self.num_bad_epochs = 0
+                            self._update_best_params()
+                        elif epoch_end:
+                            self.num_bad_epochs += 1
+                        self._save_checkpoint(is_best)
+
+                        if self.patience is not None and self.num_bad_epochs >= self.patience:
+                            if self.verbose:
+                                print(
+                                    "End of training; val_acc has not improved for %d epochs."
+                                    % self.num_bad_epochs
+                                )
+                            break
+            completed = True
+        finally:
+            self._stop_prefetch()
+            # do not let a write error replace an exception from training
+            self._close_checkpoint_writer(raise_errors=completed)
+
+        # At the end of training copy the best params back into the model, in
+        # place so that model.params keeps its tensors (and flat_update views)
+        if return_best_params and self.best_params:
+            for k, v in self.best_params.items():
+                self.model.params[k].copy_(v)
@@ -0,0 +1,219 @@
+import itertools
+import random
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+from .solver import Solver
+
+
+"""
+Utilities to run hyperparameter sweeps over many Solver instances
+"""
+
+
+def grid_search_space(model=None, optim_config=None):
+    """
+    Build every combination of the given hyperparameter values.
+
+    Inputs:
+    - model: Dictionary mapping model constructor kwargs to lists of values
+    - optim_config: Dictionary mapping optim_config keys to lists of values
+
+    Returns:
+    - configs: List of dictionaries {'model': {...}, 'optim_config': {...}}
+    """
+    model, optim_config = model or {}, optim_config or {}
+    keys = [("model", k) for k in model] + [("optim_config", k) for k in optim_config]
+    values = [model[k] for k in model] + [optim_config[k] for k in optim_config]
+    configs = []
+    for combination in itertools.product(*values):
+        config = {"model": {}, "optim_config": {}}
+        for (group, k), v in zip(keys, combination):
+            config[group][k] = v
+        configs.append(config)
+    return configs
+
+
+def random_search_space(num_samples, model=None, optim_config=None, seed=None):
+    """
+    Draw random hyperparameter configurations.
+
+    Inputs:
+    - num_samples: Number of configurations to draw
+    - model: Dictionary mapping model constructor kwargs to either a list of
+      values (sampled uniformly) or a function that takes a random.Random and
+      returns a value, e.g. lambda r: 10 ** r.uniform(-4, -2)
+    - optim_config: Same as model, for optim_config keys
+    - seed: Optional seed for the random generator
+
+    Returns:
+    - configs: List of dictionaries {'model': {...}, 'optim_config': {...}}
+    """
+    rng = random.Random(seed)
+    space = {"model": model or {}, "optim_config": optim_config or {}}
+    configs = []
+    for _ in range(num_samples):
+        config = {"model": {}, "optim_config": {}}
+        for group, choices in space.items():
+            for k, choice in choices.items():
+                config[group][k] = choice(rng) if callable(choice) else rng.choice(choice)
+        configs.append(config)
+    return configs
+
+
+# Task of the current worker process (model_fn, data, solver_kwargs), set
+# once by _init_worker
+_worker_task = None
+
+
+def _init_worker(model_fn, data, solver_kwargs, num_threads):
+    global _worker_task
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    _worker_task = (model_fn, data, solver_kwargs)
+
+
+def _run_config(args):
+    """
+    Train one configuration on the worker's dataset and return its row of the
+    results table.
+    """
+    index, config = args
+    model_fn, data, solver_kwargs = _worker_task
+    solver_kwargs = dict(solver_kwargs)
+    optim_config = dict(solver_kwargs.pop("optim_config", {}))
+    optim_config.update(config["optim_config"])
+
+    start = time.time()
+    model = model_fn(**config["model"])
+    solver = Solver(model, data, optim_config=optim_config, **solver_kwargs)
+    solver.train()
+    return {
+        "index": index,
+        "model": config["model"],
+        "optim_config": config["optim_config"],
+        "best_val_acc": solver.best_val_acc,
+        "epochs": solver.epoch,
+        "time": time.time() - start,
+        "loss_history": solver.loss_history,
+        "train_acc_history": solver.train_acc_history,
+        "val_acc_history": solver.val_acc_history,
+    }
+
+
+def run_sweep(model_fn, data, configs, solver_kwargs=None, num_workers=None,
+              num_threads=1, start_method=None):
+    """
+    Train one Solver per configuration in a pool of worker processes.
+
+    The dataset tensors are moved to shared memory once and every worker maps
+    them instead of receiving its own copy. Each worker limits itself to
+    num_threads intra-op threads so that the workers do not oversubscribe the
+    CPU. With num_workers > 0 every tensor in data must therefore be on the
+    CPU (CUDA can not be used in forked workers); e.g. load with
+    helper.get_CIFAR10_data(device='cpu'). GPU-resident data needs
+    num_workers=0, and workers that train on a GPU (solver_kwargs device
+    'cuda') need start_method='spawn'.
+
+    model_fn, data and solver_kwargs reach the workers through the pool
+    initializer, so they are only pickled when the workers are not forked;
+    only the configurations go through the task queue. With start_method
+    'spawn' or 'forkserver' (or a platform default other than 'fork'),
+    model_fn and anything in solver_kwargs such as update_rule must be
+    picklable, i.e. defined at module level rather than lambdas or closures.
+
+    Inputs:
+    - model_fn: Function (or class) building a model from the 'model' kwargs
+      of a configuration, e.g. FullyConnectedNet
+    - data: Data dictionary as passed to Solver
+    - configs: List of configurations from grid_search_space or
+      random_search_space
+    - solver_kwargs: Dictionary of keyword arguments shared by every Solver;
+      its optim_config is updated with each configuration's optim_config.
+      verbose defaults to False.
+    - num_workers: Number of worker processes; default is one per CPU given
+      num_threads each. 0 runs every configuration in this process.
+    - num_threads: Value passed to torch.set_num_threads in every worker
+    - start_method: Optional multiprocessing start method ('fork', 'spawn')
+
+    Returns:
+    - results: List with one dictionary per configuration, holding its model
+      and optim_config kwargs, best_val_acc, epochs, time and the loss / acc
+      histories, sorted by decreasing best_val_acc.
+    """
+    solver_kwargs = dict(solver_kwargs or {})
+    solver_kwargs.setdefault("verbose", False)
+    jobs = list(enumerate(configs))
+    if num_workers is None:
+        num_workers = max(torch.get_num_threads() // max(num_threads or 1, 1), 1)
+
+    if num_workers == 0:
+        _init_worker(model_fn, data, solver_kwargs, None)
+        results = [_run_config(job) for job in jobs]
+    else:
+        for k, v in data.items():
+            if torch.is_tensor(v) and v.device.type != "cpu":
+                raise ValueError(
+                    'data["%s"] is on %s; run_sweep workers need the data on the CPU '
+                    "(or num_workers=0)" % (k, v.device)
+                )
+        for v in data.values():
+            if torch.is_tensor(v):
+                v.share_memory_()
+        ctx = mp.get_context(start_method)
+        initargs = (model_fn, data, solver_kwargs, num_threads)
+        with ctx.Pool(num_workers, initializer=_init_worker, initargs=initargs) as pool:
+            results = pool.map(_run_config, jobs, chunksize=1)
+
+    results.sort(key=lambda row: row["best_val_acc"], reverse=True)
+    return results
+
+
+def successive_halving(model_fn, data, configs, min_epochs=1, eta=3,
+                       max_epochs=None, solver_kwargs=None, **sweep_kwargs):
+    """
+    Successive-halving search: train every configuration for min_epochs, keep
+    the best 1 / eta of them by best_val_acc, train those for eta times as
+    many epochs, and so on until one configuration is left or max_epochs is
+    reached. Compute is spent mostly on the promising configurations.
+
+    Every rung is a run_sweep call and promoted configurations are retrained
+    from scratch with the larger budget. solver_kwargs may also set patience
+    to stop unpromising runs early within a rung.
+
+    Inputs:
+    - model_fn, data, configs, solver_kwargs: Same as run_sweep
+    - min_epochs: Number of epochs every configuration gets in the first rung
+    - eta: Reduction factor between rungs; must be at least 2
+    - max_epochs: Optional cap on the number of epochs of any rung
+    - sweep_kwargs: Other keyword arguments passed on to run_sweep
+
+    Returns:
+    - results: List with one row per (configuration, rung) as in run_sweep,
+      plus 'config_index' (position in configs) and 'rung' keys; the rows of
+      the last rung come first, each rung sorted by decreasing best_val_acc.
+    """
+    if eta < 2:
+        raise ValueError("eta must be at least 2; got %r" % (eta,))
+    solver_kwargs = dict(solver_kwargs or {})
+    survivors = list(range(len(configs)))
+    num_epochs, rung = min_epochs, 0
+    results = []
+    while True:
+        solver_kwargs["num_epochs"] = num_epochs
+        rows = run_sweep(model_fn, data, [configs[i] for i in survivors],
+                         solver_kwargs=solver_kwargs, **sweep_kwargs)
+        for row in rows:
+            row["config_index"] = survivors[row["index"]]
+            row["rung"] = rung
+        results = rows + results
+
+        num_keep = len(survivors) // eta
+        next_epochs = num_epochs * eta
+        if num_keep < 1 or (max_epochs is not None and next_epochs > max_epochs):
+            break
+        survivors = [row["config_index"] for row in rows[:num_keep]]
+        num_epochs, rung = next_epochs, rung + 1
+    return results
@@ -1,13 +1,20 @@
+import math
 import random
 
 import torch
+import torch.multiprocessing as mp
 
 import utils
 
+try:
+    from torch.func import vmap
+except ImportError:  # torch < 2.0
+    vmap = None
+
 """ Utilities for computing and checking gradients. """
 
 
-def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-7):
+def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-7, num_workers=0):
     """
     Utility function to perform numeric gradient checking. We use the centered
     difference formula to compute a numeric derivative:
@@ -23,21 +30,30 @@ def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-7):
     - analytic_grad: A torch tensor giving the analytic gradient of f at x
     - num_checks: The number of dimensions along which to check
     - h: Step size for computing numeric derivatives
+    - num_workers: If positive, evaluate the checks in this many worker
+      processes as in compute_numeric_gradient_parallel
     """
     # fix random seed to 0
     utils.reset_seed(0)
-    for i in range(num_checks):
+    ixs = [tuple([random.randrange(m) for m in x.shape]) for _ in range(num_checks)]
 
-        ix = tuple([random.randrange(m) for m in x.shape])
+    if num_workers:
+        flat_idx = torch.tensor([_ravel_index(ix, x.shape) for ix in ixs])
+        dLdf = torch.ones(1, dtype=x.dtype)
+        numerical = _parallel_partials(f, x, flat_idx, dLdf, h, num_workers).tolist()
 
-        oldval = x[ix].item()
-        x[ix] = oldval + h  # increment by h
-        fxph = f(x).item()  # evaluate f(x + h)
-        x[ix] = oldval - h  # increment by h
-        fxmh = f(x).item()  # evaluate f(x - h)
-        x[ix] = oldval  # reset
+    for i, ix in enumerate(ixs):
+        if num_workers:
+            grad_numerical = numerical[i]
+        else:
+            oldval = x[ix].item()
+            x[ix] = oldval + h  # increment by h
+            fxph = f(x).item()  # evaluate f(x + h)
+            x[ix] = oldval - h  # increment by h
+            fxmh = f(x).item()  # evaluate f(x - h)
+            x[ix] = oldval  # reset
+            grad_numerical = (fxph - fxmh) / (2 * h)
 
-        grad_numerical = (fxph - fxmh) / (2 * h)
         grad_analytic = analytic_grad[ix]
         rel_error_top = abs(grad_numerical - grad_analytic)
         rel_error_bot = abs(grad_numerical) + abs(grad_analytic) + 1e-12
@@ -100,6 +116,241 @@ def compute_numeric_gradient(f, x, dLdf=None, h=1e-7):
     return grad
 
 
+def _scalar_partial(f, x, i, dLdf, h):
+    """
+    Centered difference of dLdf . f along flat coordinate i of x, perturbing
+    x in place as compute_numeric_gradient does.
+    """
+    flat_x = x.view(-1)
+    oldval = flat_x[i].item()
+    flat_x[i] = oldval + h
+    fxph = f(x).flatten()
+    flat_x[i] = oldval - h
+    fxmh = f(x).flatten()
+    flat_x[i] = oldval
+    return dLdf.dot((fxph - fxmh) / (2 * h)).item()
+
+
+def _partials_mode(vectorized):
+    mode = {False: "loop", True: "batch", "vmap": "vmap"}.get(vectorized)
+    if mode is None:
+        raise ValueError('Invalid vectorized "%s"' % vectorized)
+    if mode == "vmap" and vmap is None:
+        raise ValueError("vectorized='vmap' needs torch.func (torch >= 2.0)")
+    return mode
+
+
+def _eval_point(f, x, vectorized):
+    """
+    f at the single point x. A batched f (vectorized=True) is called on a
+    stack of one.
+    """
+    if _partials_mode(vectorized) == "batch":
+        return f(x.unsqueeze(0))[0]
+    return f(x)
+
+
+def _numeric_partials(f, x, flat_idx, dLdf, h, batch_size, vectorized):
+    """
+    Centered differences of dLdf . f along the flat coordinates flat_idx of x.
+
+    With vectorized False, x is perturbed one coordinate at a time. Otherwise
+    chunks of k coordinates are evaluated at once on a (2k, *x.shape) stack
+    whose first k rows are x + h * e_i and last k rows are x - h * e_i. The
+    first partial is then compared against a separate evaluation: for vmap
+    the scalar loop, which catches an f that ignores its argument (vmap
+    broadcasts its output, so every difference would silently be 0); for a
+    batched f two stacks of one, which catches an f that mixes up rows.
+
+    Returns a 1D tensor with one partial derivative per entry of flat_idx.
+    """
+    mode = _partials_mode(vectorized)
+    out = torch.empty(len(flat_idx), dtype=x.dtype, device=x.device)
+    if mode == "loop":
+        for j in range(len(flat_idx)):
+            out[j] = _scalar_partial(f, x, flat_idx[j].item(), dLdf, h)
+        return out
+
+    base = x.detach().reshape(1, -1)
+    for start in range(0, len(flat_idx), batch_size):
+        idx = flat_idx[start:start + batch_size]
+        k = idx.shape[0]
+        rows = torch.arange(2 * k, device=x.device)
+        xs = base.repeat(2 * k, 1)
+        xs[rows, idx.repeat(2)] += torch.cat([
+            torch.full((k,), h, dtype=x.dtype, device=x.device),
+            torch.full((k,), -h, dtype=x.dtype, device=x.device),
+        ])
+        xs = xs.view(2 * k, *x.shape)
+        fxs = f(xs) if mode == "batch" else vmap(f)(xs)
+        fxs = fxs.reshape(2 * k, -1)
+        dfdx = (fxs[:k] - fxs[k:]) / (2 * h)
+        out[start:start + k] = dfdx.matmul(dLdf.to(dfdx.dtype))
+
+        if start == 0:
+            if mode == "vmap":
+                expected = _scalar_partial(f, x, idx[0].item(), dLdf, h)
+            else:
+                fxph = _eval_point(f, xs[0], vectorized).flatten()
+                fxmh = _eval_point(f, xs[k], vectorized).flatten()
+                expected = dLdf.to(fxph.dtype).dot((fxph - fxmh) / (2 * h)).item()
+            if not math.isclose(out[0].item(), expected, rel_tol=1e-2, abs_tol=1e-6):
+                raise ValueError(
+                    "batched evaluation of f gives %e but a single evaluation gives %e; "
+                    "vectorized=%r needs f to be a pure function of its argument"
+                    % (out[0].item(), expected, vectorized)
+                )
+    return out
+
+
+def _check_indices(x, num_checks, seed):
+    """
+    Flat indices of the coordinates of x to check (all of them, or num_checks
+    random ones) and the tensor to write the numeric gradient to.
+    """
+    if num_checks is None:
+        return torch.arange(x.numel(), device=x.device), torch.empty_like(x)
+    gen = torch.Generator()
+    if seed is not None:
+        gen.manual_seed(seed)
+    flat_idx = torch.randperm(x.numel(), generator=gen)[:num_checks].to(x.device)
+    return flat_idx, torch.full_like(x, float("nan"))
+
+
+def compute_numeric_gradient_batched(f, x, dLdf=None, h=1e-7, batch_size=32,
+                                     vectorized=False, num_checks=None, seed=None):
+    """
+    Same as compute_numeric_gradient, but can evaluate f on batch_size
+    perturbed copies of x per call instead of one, which removes most of the
+    Python overhead of 2 * x.numel() separate forward passes.
+
+    The batched modes need f to be a pure function of its argument. A
+    closure that ignores it, like the usual f = lambda _: model.loss(X, y)[0]
+    (which relies on x being perturbed in place), only works with the
+    default scalar loop; the batched modes raise a ValueError for it.
+
+    Inputs:
+    - f: A function that inputs a torch tensor and returns a torch tensor
+    - x: A contiguous torch tensor giving the point at which to compute the
+      gradient
+    - dLdf: optional upstream gradient for intermediate layers, shaped like
+      the output of f for a single x
+    - h: epsilon used in the finite difference calculation
+    - batch_size: Number of coordinates perturbed per evaluation; memory use
+      is about 2 * batch_size copies of x and of f(x)
+    - vectorized: How f is evaluated:
+      - False (default): the scalar loop of compute_numeric_gradient
+      - True: f itself is batched, i.e. maps a stack xs of shape
+        (B, *x.shape) to a tensor of shape (B, ...)
+      - 'vmap': f is evaluated on the stack through torch.func.vmap
+    - num_checks: If given, only compute the gradient along this many random
+      coordinates of x
+    - seed: Optional seed for choosing the coordinates
+
+    Returns:
+    - grad: A tensor of the same shape as x giving the gradient of f at x.
+      If num_checks is given, the entries that were not checked are NaN;
+      compare only the checked ones, e.g. with mask = ~grad.isnan():
+      rel_error(grad[mask], dx[mask])
+    """
+    if not x.is_contiguous():
+        raise ValueError("x must be contiguous")
+    if dLdf is None:
+        dLdf = torch.ones_like(_eval_point(f, x, vectorized))
+    dLdf = dLdf.flatten()
+
+    flat_idx, grad = _check_indices(x, num_checks, seed)
+
+    partials = _numeric_partials(f, x, flat_idx, dLdf, h, batch_size, vectorized)
+    grad.view(-1)[flat_idx] = partials
+    return grad
+
+
+def _ravel_index(ix, shape):
+    flat = 0
+    for i, m in zip(ix, shape):
+        flat = flat * m + i
+    return flat
+
+
+# Task of the current gradient worker process, set once by _init_grad_worker
+_grad_task = None
+
+
+def _init_grad_worker(task):
+    global _grad_task
+    torch.set_num_threads(1)
+    _grad_task = task
+
+
+def _grad_shard(flat_idx):
+    f, x, dLdf, h, batch_size, vectorized = _grad_task
+    return _numeric_partials(f, x, flat_idx, dLdf, h, batch_size, vectorized)
+
+
+def _parallel_partials(f, x, flat_idx, dLdf, h, num_workers,
+                       batch_size=32, vectorized=False):
+    """
+    _numeric_partials with flat_idx split into shards over a pool of forked
+    worker processes. Forking gives every worker a private copy-on-write copy
+    of x and of everything f refers to (e.g. the model params), so each
+    worker can perturb its own x in place, and f does not need to be
+    picklable.
+    """
+    if x.device.type != "cpu":
+        raise ValueError("parallel gradient checks need x on the CPU")
+    if "fork" not in mp.get_all_start_methods():
+        raise ValueError("parallel gradient checks need the 'fork' start method")
+    if num_workers is None:
+        num_workers = torch.get_num_threads()
+    # a few shards per worker to even out the load
+    shards = [s for s in torch.tensor_split(flat_idx, 4 * num_workers) if len(s) > 0]
+    task = (f, x, dLdf, h, batch_size, vectorized)
+    ctx = mp.get_context("fork")
+    with ctx.Pool(num_workers, initializer=_init_grad_worker, initargs=(task,)) as pool:
+        partials = pool.map(_grad_shard, shards, chunksize=1)
+    return torch.cat(partials)
+
+
+def compute_numeric_gradient_parallel(f, x, dLdf=None, h=1e-7, num_workers=None,
+                                      num_checks=None, seed=None, batch_size=32,
+                                      vectorized=False):
+    """
+    Same as compute_numeric_gradient_batched, but the coordinates of x are
+    split into shards that are evaluated by a pool of worker processes, so a
+    full numeric check, e.g. of rnn_forward with respect to Wx or h0, scales
+    with the number of cores.
+
+    Workers are forked: each gets a copy-on-write copy of x and of the tensors
+    f refers to, and perturbs its own copy. x must be a contiguous CPU tensor,
+    and the platform must support the 'fork' start method. Every worker runs
+    with one intra-op thread.
+
+    Inputs:
+    - f, x, dLdf, h, num_checks, seed, batch_size: Same as
+      compute_numeric_gradient_batched
+    - num_workers: Number of worker processes; default is one per CPU
+    - vectorized: Same as compute_numeric_gradient_batched, applied within
+      each worker
+
+    Returns:
+    - grad: A tensor of the same shape as x giving the gradient of f at x,
+      with NaN for the entries that were not checked if num_checks is given
+    """
+    if not x.is_contiguous():
+        raise ValueError("x must be contiguous")
+    if dLdf is None:
+        dLdf = torch.ones_like(_eval_point(f, x, vectorized))
+    dLdf = dLdf.flatten()
+
+    flat_idx, grad = _check_indices(x, num_checks, seed)
+
+    partials = _parallel_partials(f, x, flat_idx, dLdf, h, num_workers,
+                                  batch_size, vectorized)
+    grad.view(-1)[flat_idx] = partials
+    return grad
+
+
 def rel_error(x, y, eps=1e-10):
     """
     Compute the relative error between a pair of tensors x and y,